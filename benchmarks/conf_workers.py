@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Measures ConfServer requests/second with 1..N worker processes sharing one
+# port through SO_REUSEPORT, driven by as many client processes with
+# concurrent keep-alive connections. Pass --ssl to serve HTTPS with the
+# configured certificates.
+# Run from the repository root: python benchmarks/conf_workers.py [max_workers]
+
+import asyncio
+import multiprocessing
+import os
+import ssl
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+
+import bumper
+
+PORT = 18007
+PATH = "/1/private/us/en/dev_1234/ios/1/0/0/common/checkVersion"
+DURATION = 5
+CONCURRENCY = 20
+
+
+async def hammer(url, deadline):
+    ssl_ctx = ssl.create_default_context()
+    ssl_ctx.check_hostname = False
+    ssl_ctx.verify_mode = ssl.CERT_NONE
+    connector = aiohttp.TCPConnector(ssl=ssl_ctx, limit=CONCURRENCY)
+    count = 0
+
+    async def worker(session):
+        nonlocal count
+        while time.perf_counter() < deadline:
+            async with session.get(url) as resp:
+                await resp.read()
+            count += 1
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[worker(session) for _ in range(CONCURRENCY)])
+    return count
+
+
+def client(url, deadline, results):
+    results.put(asyncio.new_event_loop().run_until_complete(hammer(url, deadline)))
+
+
+def measure(workers, usessl):
+    servers = bumper.start_conf_workers(
+        [(("127.0.0.1", PORT), usessl)], workers, ("127.0.0.1", bumper.conf_owner_port)
+    )
+    time.sleep(2)  # Worker startup
+
+    url = "{}://127.0.0.1:{}{}".format("https" if usessl else "http", PORT, PATH)
+    deadline = time.perf_counter() + DURATION
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(target=client, args=(url, deadline, results))
+        for _ in range(workers)
+    ]
+    for proc in clients:
+        proc.start()
+    total = sum(results.get() for _ in clients)
+    for proc in clients + servers:
+        proc.terminate()
+        proc.join()
+    return total / DURATION
+
+
+def main(max_workers, usessl):
+    bumper.db = os.path.join(tempfile.gettempdir(), "bumper_conf_workers.db")
+    bumper.db_engine = "sqlite"
+    bumper.db_open()
+
+    print("{} cores".format(os.cpu_count()))
+    for workers in range(1, max_workers + 1):
+        rate = measure(workers, usessl)
+        print("{:>2} workers: {:8.0f} requests/s".format(workers, rate))
+
+    bumper.db_close()
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--ssl"]
+    main(int(args[0]) if args else os.cpu_count(), "--ssl" in sys.argv)
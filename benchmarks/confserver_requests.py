@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Measures ConfServer requests/second per endpoint on the server side only:
+# route resolution, the handler and building the response body, driven with
+# a mocked request so client and socket overhead stay out of the numbers.
+# Run from the repository root: python benchmarks/confserver_requests.py [count]
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import make_mocked_request
+
+import bumper
+
+PRIVATE = "/1/private/us/en/dev_1234/ios/1/0/0/"
+ENDPOINTS = [
+    ("GET", PRIVATE + "common/checkVersion"),
+    ("GET", PRIVATE + "user/checkAgreement"),
+    ("GET", PRIVATE + "campaign/homePageAlert"),
+    ("GET", PRIVATE + "user/logout?accessToken=none"),
+    ("POST", "/api/pim/product/getProductIotMap"),
+]
+
+
+async def dispatch(app, request):
+    match = await app.router.resolve(request)
+    request._match_info = match
+    response = await match.handler(request)
+    return response.body
+
+
+async def run(count):
+    confserver = bumper.ConfServer(("127.0.0.1", 0), usessl=False)
+    confserver.confserver_app()
+    app = confserver.app
+    app.freeze()
+
+    for method, path in ENDPOINTS:
+        # Mocked requests are slow to build, reuse one per endpoint
+        request = make_mocked_request(method, path, app=app)
+        await dispatch(app, request)  # Warm up
+        start = time.perf_counter()
+        for _ in range(count):
+            await dispatch(app, request)
+        rate = count / (time.perf_counter() - start)
+        print("{:>60}: {:8.0f} requests/s".format(path.split("?")[0], rate))
+
+
+def main(count):
+    bumper.db = os.path.join(tempfile.gettempdir(), "bumper_conf_bench.db")
+    if os.path.exists(bumper.db):
+        os.remove(bumper.db)
+    asyncio.get_event_loop().run_until_complete(run(count))
+    bumper.db_close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
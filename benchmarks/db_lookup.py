@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Times bot_get() lookups against databases of increasing size, using the
+# shared handle and reopening the database for every lookup (the old db_get()).
+# Run from the repository root: python benchmarks/db_lookup.py
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bumper
+
+LOOKUPS = 200
+
+
+def populate(count):
+    bumper.db_write_cache_size = count + 1
+    for i in range(count):
+        bumper.bot_add(
+            "sn_{}".format(i), "did_{}".format(i), "cls", "res_{}".format(i), "eco-ng"
+        )
+    bumper.db_close()
+    bumper.db_write_cache_size = 1
+
+
+def time_lookups(count, reopen):
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        if reopen:
+            bumper.db_close()
+        bumper.bot_get("did_{}".format(i % count))
+    return (time.perf_counter() - start) / LOOKUPS * 1000000
+
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bumper.db_close()
+        bumper.db = os.path.join(tmpdir, "bench.db")
+        populate(count)
+        size = os.path.getsize(bumper.db)
+
+        reopened = time_lookups(count, reopen=True)
+        shared = time_lookups(count, reopen=False)
+        bumper.db_close()
+
+    print(
+        "{:>6} bots {:>9} bytes: reopen {:9.1f} us/lookup, shared {:9.1f} us/lookup".format(
+            count, size, reopened, shared
+        )
+    )
+
+
+if __name__ == "__main__":
+    for count in (10, 100, 1000, 2000):
+        bench(count)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# Times bot_set_nick() writes against databases of increasing size for each
+# storage backend.
+# Run from the repository root: python benchmarks/db_write.py
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bumper
+
+WRITES = 100
+
+
+def bench(engine, count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bumper.db_close()
+        bumper.db_engine = engine
+        bumper.db = os.path.join(tmpdir, "bench.db")
+        storage = bumper.db_get()
+        for i in range(count):
+            storage.bot_upsert(
+                bumper.VacBotDevice("did_{}".format(i), "cls", "res", "sn").asdict()
+            )
+
+        start = time.perf_counter()
+        for i in range(WRITES):
+            bumper.bot_set_nick("did_{}".format(i % count), "nick_{}".format(i))
+        elapsed = time.perf_counter() - start
+        bumper.db_close()
+
+    print(
+        "{:>6} {:>6} bots: {:9.1f} us/write".format(
+            engine, count, elapsed / WRITES * 1000000
+        )
+    )
+
+
+if __name__ == "__main__":
+    for engine in ("tinydb", "sqlite"):
+        for count in (10, 100, 1000):
+            bench(engine, count)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Minimal XMPP client and server process helpers shared by the XMPP benchmarks.
+
+import asyncio
+import base64
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bumper
+
+PORT = 15223
+STREAM_HEADER = '<stream:stream to="{}" xmlns="jabber:client" xmlns:stream="http://etherx.jabber.org/streams" version="1.0">'
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve():
+    raise_fd_limit()
+    bumper.db = os.path.join(tempfile.gettempdir(), "bumper_xmpp_bench.db")
+    if os.path.exists(bumper.db):
+        os.remove(bumper.db)
+    xmppserver = bumper.XMPPServer(("127.0.0.1", PORT), usessl=False)
+    xmppserver.run_server(asyncio.new_event_loop())
+
+
+def start_server():
+    # Run the server in its own process so it gets a core to itself
+    raise_fd_limit()
+    server = multiprocessing.Process(target=serve, daemon=True)
+    server.start()
+    time.sleep(1)
+    return server
+
+
+def local_ip(i):
+    # Spread clients over loopback addresses, the server evicts same-IP sessions
+    return "127.{}.{}.{}".format(1 + i // 65025, (i // 255) % 255, 1 + i % 255)
+
+
+class XMPPClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.received = ""
+
+    def send(self, data):
+        self.writer.write(data.encode())
+
+    async def expect(self, text):
+        # Read until text shows up, then consume everything up to it
+        while text not in self.received:
+            data = await self.reader.read(65536)
+            if data == b"":
+                raise ConnectionError("connection closed waiting for {}".format(text))
+            self.received += data.decode("utf-8")
+        _, _, self.received = self.received.partition(text)
+
+    def close(self):
+        self.writer.close()
+
+
+async def connect(i):
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", PORT, local_addr=(local_ip(i), 0)
+    )
+    return XMPPClient(reader, writer)
+
+
+async def login(client, uid, to, sasl, resource):
+    client.send(STREAM_HEADER.format(to))
+    await client.expect("</stream:features>")
+    client.send(
+        '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" mechanism="PLAIN">{}</auth>'.format(
+            base64.b64encode(sasl.encode()).decode()
+        )
+    )
+    await client.expect("<success")
+    client.send(STREAM_HEADER.format(to))
+    await client.expect("</stream:features>")
+    client.send(
+        '<iq type="set" id="1"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><resource>{}</resource></bind></iq>'.format(
+            resource
+        )
+    )
+    await client.expect("</jid>")
+    client.send(
+        '<iq type="set" id="2"><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></iq>'
+    )
+    await client.expect('id="2"')
+    return client
+
+
+async def login_bot(i, did):
+    client = await connect(i)
+    return await login(
+        client, did, "ls1ok3.ecorobot.net", "\x00{}\x000".format(did), "atom"
+    )
+
+
+async def login_controller(i, uid, resource):
+    client = await connect(i)
+    return await login(
+        client,
+        uid,
+        "ecouser.net",
+        "\x00{}\x00/{}/authcode".format(uid, resource),
+        resource,
+    )
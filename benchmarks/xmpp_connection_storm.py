@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Logs in N bots at the same time against an XMPPServer running in a child
+# process and reports each bot's time from connect to READY (session bound),
+# like a building's worth of bots coming back after a power cut.
+# Run from the repository root: python benchmarks/xmpp_connection_storm.py [count]
+
+import asyncio
+import statistics
+import sys
+import time
+
+from xmpp_client import login_bot, start_server
+
+
+async def time_to_ready(i):
+    start = time.perf_counter()
+    bot = await login_bot(i, "did_{}".format(i))
+    return time.perf_counter() - start, bot
+
+
+async def storm(count):
+    start = time.perf_counter()
+    results = await asyncio.gather(*[time_to_ready(i) for i in range(count)])
+    elapsed = time.perf_counter() - start
+    for _, bot in results:
+        bot.close()
+    return elapsed, sorted(result[0] * 1000 for result in results)
+
+
+def main(count):
+    server = start_server()
+    elapsed, times = asyncio.get_event_loop().run_until_complete(storm(count))
+    server.terminate()
+
+    print(
+        "{} bots READY in {:.2f}s: median {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+            count,
+            elapsed,
+            statistics.median(times),
+            times[int(len(times) * 0.99) - 1],
+            times[-1],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
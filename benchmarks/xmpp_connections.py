@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Opens thousands of idle XMPP connections against an XMPPServer running in a
+# child process, and reports the server's memory, thread count and CPU time.
+# Run from the repository root: python benchmarks/xmpp_connections.py [count]
+
+import asyncio
+import os
+import sys
+import time
+
+from xmpp_client import PORT, STREAM_HEADER, local_ip, start_server
+
+
+def proc_status(pid):
+    status = {}
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+    return status
+
+
+def proc_cpu_seconds(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def connect(i):
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", PORT, local_addr=(local_ip(i), 0)
+    )
+    writer.write(STREAM_HEADER.format("ecouser.net").encode())
+    received = b""
+    while b"</stream:features>" not in received:
+        received += await reader.read(4096)
+    return writer
+
+
+async def open_connections(count):
+    writers = []
+    for start in range(0, count, 200):
+        batch = range(start, min(start + 200, count))
+        writers.extend(await asyncio.gather(*[connect(i) for i in batch]))
+    return writers
+
+
+def main(count):
+    server = start_server()
+
+    before = proc_status(server.pid)
+    cpu_before = proc_cpu_seconds(server.pid)
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    writers = loop.run_until_complete(open_connections(count))
+    elapsed = time.perf_counter() - start
+    loop.run_until_complete(asyncio.sleep(5))  # Let the connections sit idle
+    after = proc_status(server.pid)
+    cpu_idle = proc_cpu_seconds(server.pid)
+    loop.run_until_complete(asyncio.sleep(5))
+    cpu_after = proc_cpu_seconds(server.pid)
+
+    print(
+        "{} connections in {:.2f}s, server threads {} -> {}, rss {} -> {}".format(
+            len(writers),
+            elapsed,
+            before["Threads"],
+            after["Threads"],
+            before["VmRSS"],
+            after["VmRSS"],
+        )
+    )
+    print(
+        "server cpu: {:.2f}s to connect, {:.2f}s over 5s idle".format(
+            cpu_idle - cpu_before, cpu_after - cpu_idle
+        )
+    )
+
+    for writer in writers:
+        writer.close()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Times controller -> bot -> controller ctl round trips through an XMPPServer
+# running in a child process (_handle_ctl forwards the request, _handle_result
+# forwards the answer).
+# Run from the repository root: python benchmarks/xmpp_ctl_latency.py [count]
+
+import asyncio
+import statistics
+import sys
+import time
+
+from xmpp_client import login_bot, login_controller, start_server
+
+CTL = '<iq type="set" id="{}" to="did_1@ls1ok3.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="GetCleanState"/></query></iq>'
+RESULT = '<iq type="result" id="{}" to="fuid_1@ecouser.net/res_1"><query xmlns="com:ctl"><ctl ret="ok"><clean>{}</clean></ctl></query></iq>'
+
+
+async def answer(bot):
+    # Answer each ctl as soon as it arrives, like a bot would
+    i = 0
+    while True:
+        await bot.expect('td="GetCleanState"')
+        bot.send(RESULT.format(i, i))
+        i += 1
+
+
+async def roundtrips(count):
+    bot = await login_bot(1, "did_1")
+    controller = await login_controller(2, "fuid_1", "res_1")
+    responder = asyncio.ensure_future(answer(bot))
+
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        controller.send(CTL.format(i))
+        await controller.expect("<clean>{}</clean>".format(i))
+        times.append((time.perf_counter() - start) * 1000)
+
+    responder.cancel()
+    bot.close()
+    controller.close()
+    return times
+
+
+def main(count):
+    server = start_server()
+    times = asyncio.get_event_loop().run_until_complete(roundtrips(count))
+    server.terminate()
+
+    times.sort()
+    print(
+        "{} ctl round trips: median {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            count,
+            statistics.median(times),
+            times[int(len(times) * 0.99) - 1],
+            times[-1],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Compares preparing a forwarded stanza the old way (set from on the parsed
+# element, ET.tostring and ns0 string patching) with stanza_set_from on the
+# raw stanza, then measures end to end ctl forwarding through an XMPPServer
+# running in a child process.
+# Run from the repository root: python benchmarks/xmpp_forward.py [count]
+
+import asyncio
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from xmpp_client import login_bot, login_controller, start_server
+
+from bumper.xmppserver import StreamParser, stanza_set_from
+
+CTL = '<iq type="set" id="{}" to="did_1@ls1ok3.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="GetCleanState"/></query></iq>'
+RESULT = '<iq type="result" id="{}" to="fuid_1@ecouser.net/res_1"><query xmlns="com:ctl"><ctl ret="ok" td="CleanReport"><clean type="auto" speed="standard" st="h" t="" a=""/></ctl></query></iq>'
+JID = "did_1@ls1ok3.ecorobot.net/atom"
+
+
+def forward_tostring(xml):
+    xml.attrib["from"] = JID
+    rxmlstring = ET.tostring(xml).decode("utf-8")
+    rxmlstring = rxmlstring.replace("xmlns:ns0=", "xmlns=")
+    rxmlstring = rxmlstring.replace("ns0:", "")
+    rxmlstring = rxmlstring.replace('iq xmlns="com:ctl"', "iq")
+    rxmlstring = rxmlstring.replace("<query", '<query xmlns="com:ctl"')
+    return rxmlstring.encode()
+
+
+def forward_raw(raw):
+    return stanza_set_from(raw, JID).encode()
+
+
+def time_forward(count):
+    parser = StreamParser()
+    parser.feed(
+        b'<stream:stream xmlns="jabber:client" xmlns:stream="http://etherx.jabber.org/streams">'
+    )
+    _, xml, raw = parser.feed(RESULT.format(1).encode())[0]
+    raw = raw.decode("utf-8")
+
+    for name, forward, stanza in (
+        ("ET.tostring + replace", forward_tostring, xml),
+        ("stanza_set_from", forward_raw, raw),
+    ):
+        start = time.perf_counter()
+        for i in range(count):
+            forward(stanza)
+        elapsed = time.perf_counter() - start
+        print("{:>22}: {:10.0f} stanzas/s".format(name, count / elapsed))
+
+
+async def flood(count):
+    bot = await login_bot(1, "did_1")
+    controller = await login_controller(2, "fuid_1", "res_1")
+
+    start = time.perf_counter()
+    for i in range(count):
+        bot.send(RESULT.format(i))
+        if i % 100 == 99 or i == count - 1:
+            # Keep at most 100 stanzas in flight
+            await controller.expect('id="{}"'.format(i))
+    elapsed = time.perf_counter() - start
+
+    bot.close()
+    controller.close()
+    return elapsed
+
+
+def main(count):
+    time_forward(count * 10)
+
+    server = start_server()
+    elapsed = asyncio.get_event_loop().run_until_complete(flood(count))
+    server.terminate()
+    print("{:>22}: {:10.0f} stanzas/s".format("bot -> controller", count / elapsed))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,19 +1,23 @@
 #!/usr/bin/env python3
 
 from .confserver import ConfServer
+from .confserver import start_conf_workers
 from .mqttserver import MQTTServer
 from .mqttserver import MQTTHelperBot
 from .xmppserver import XMPPServer
+from .storage import BumperStorage, TinyDBStorage, SQLiteStorage
 import asyncio
 import contextvars
+import functools
+import threading
 import time
-from datetime import datetime, timedelta
 import platform
 import os
 import logging
+import socket
+import ssl
 from base64 import b64decode, b64encode
-from tinydb import TinyDB, Query
-from tinydb.storages import MemoryStorage
+from concurrent.futures import ThreadPoolExecutor
 
 bumper_users_var = contextvars.ContextVar("bumper_users", default=[])
 bumper_clients_var = contextvars.ContextVar("bumper_clients", default=[])
@@ -23,9 +27,50 @@ ca_cert = "./certs/CA/cacert.pem"
 server_cert = "./certs/cert.pem"
 server_key = "./certs/key.pem"
 
+server_ip = None  # Address given to bots and apps by FindBest, None to resolve it
+
 use_auth = False
 token_validity_seconds = 3600  # 1 hour
 db = None
+db_engine = "tinydb"  # Storage backend, "tinydb" or "sqlite"
+# Number of TinyDB writes held in memory before flushing to disk
+db_write_cache_size = 1
+
+# XMPP send buffering, bytes queued for a connection above the high water mark
+# make it a slow consumer, handled by the policy: "drop" further stanzas,
+# "disconnect" it, or "block" the senders until it drains below the low mark
+xmpp_send_high_water = 256 * 1024
+xmpp_send_low_water = 64 * 1024
+xmpp_slow_consumer = "disconnect"
+xmpp_block_timeout = 10  # Seconds a blocked sender waits before disconnecting
+xmpp_listen_backlog = 1024  # Pending XMPP connections, capped by the OS (somaxconn)
+xmpp_ip_rate_limit = None  # (connections, seconds) allowed per IP, None for no limit
+
+# Concurrent identical read-only bot commands share one MQTT round trip, and
+# their results are reused for this many seconds (0 to always ask the bot)
+helperbot_result_ttl = 1.0
+
+# ConfServer worker processes sharing the HTTPS ports with SO_REUSEPORT, 0 to
+# serve them from threads in this process. Workers need the sqlite engine and
+# forward bot commands to this process on conf_owner_port (loopback).
+conf_workers = 0
+conf_owner_port = 8010
+
+# Shared database handle, see db_open()
+db_handle = None
+db_handle_file = None
+db_lock = threading.RLock()
+
+# Announced server address, see server_address()
+server_address_resolved = None
+
+# Shared TLS server context, see ssl_server_context()
+ssl_context = None
+ssl_context_files = None
+ssl_lock = threading.Lock()
+
+# Storage calls made from event loops run here, see db_run()
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bumper_db")
 
 # Logs
 bumperlog = logging.getLogger("bumper")
@@ -54,6 +99,11 @@ def db_file():
     return os_db_path()
 
 
+def sqlite_db_file():
+    # The SQLite database lives next to the TinyDB file it migrates from
+    return "{}.sqlite3".format(os.path.splitext(db_file())[0])
+
+
 def os_db_path():
     if platform.system() == "Windows":
         return os.path.join(os.getenv("APPDATA"), "bumper.db")
@@ -61,17 +111,163 @@ def os_db_path():
         return os.path.expanduser("~/.config/bumper.db")
 
 
+def db_open():
+    # Opens the shared storage backend, or returns it if already open
+    global db_handle, db_handle_file
+    with db_lock:
+        if db_engine == "sqlite":
+            dbfile = sqlite_db_file()
+        else:
+            dbfile = db_file()
+
+        if db_handle is not None:
+            if db_handle_file == dbfile:
+                return db_handle
+            db_close()  # Database location or engine changed, reopen
+
+        if db_engine == "sqlite":
+            db_handle = SQLiteStorage(dbfile, migrate_from=db_file())
+        else:
+            db_handle = TinyDBStorage(dbfile, write_cache_size=db_write_cache_size)
+        db_handle_file = dbfile
+
+        return db_handle
+
+
 def db_get():
-    # Will create the database if it doesn't exist
-    db = TinyDB(db_file())
+    return db_open()
+
+
+def db_flush():
+    with db_lock:
+        if db_handle is not None:
+            db_handle.flush()
+
+
+def db_close():
+    global db_handle, db_handle_file
+    with db_lock:
+        if db_handle is not None:
+            db_handle.close()
+            db_handle = None
+            db_handle_file = None
+
+
+def server_address():
+    # Resolved once and cached, provisioning bursts must not hit the resolver
+    if server_address_resolved is None:
+        return refresh_server_address()
+    return server_address_resolved
+
+
+def refresh_server_address():
+    # Called at startup and on SIGHUP, server_ip overrides the hostname lookup
+    global server_address_resolved
+    if server_ip:
+        server_address_resolved = server_ip
+    else:
+        server_address_resolved = socket.gethostbyname(socket.gethostname())
+    bumperlog.info("Announcing server address {}".format(server_address_resolved))
+    return server_address_resolved
+
+
+def ssl_server_context():
+    # One server context for the ConfServer TLS listeners, loaded once, so
+    # they share the session cache and ticket keys and reconnecting apps and
+    # bots can resume sessions instead of doing full handshakes. XMPP on 5223
+    # is plaintext and MQTT builds its own context, neither is counted here
+    global ssl_context, ssl_context_files
+    with ssl_lock:
+        files = (server_cert, server_key)
+        if ssl_context is None or ssl_context_files != files:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile=server_cert, keyfile=server_key)
+            ssl_context = context
+            ssl_context_files = files
+
+        return ssl_context
+
+
+def ssl_handshake_stats():
+    # Server handshakes on the shared context, full and resumed (from the
+    # session cache or a session ticket)
+    with ssl_lock:
+        if ssl_context is None:
+            return {"full": 0, "resumed": 0, "incomplete": 0}
+        stats = ssl_context.session_stats()
+
+    return {
+        "full": stats["accept_good"] - stats["hits"],
+        "resumed": stats["hits"],
+        "incomplete": stats["accept"] - stats["accept_good"],
+    }
+
+
+class PresenceRegistry(object):
+    # Volatile record of which bots (by did) and clients (by resource) are
+    # connected over each protocol, and when they were last seen.
+    # Nothing here is persisted, the database only holds durable records.
+
+    protocols = ("mqtt", "xmpp")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {protocol: {} for protocol in self.protocols}
+
+    def set(self, kind, key, protocol, connected):
+        with self.lock:
+            self.entries[protocol][(kind, key)] = {
+                "connected": connected,
+                "last_seen": time.time(),
+            }
+
+    def is_connected(self, kind, key, protocol):
+        with self.lock:
+            entry = self.entries[protocol].get((kind, key))
+            return entry is not None and entry["connected"]
+
+    def last_seen(self, kind, key, protocol):
+        with self.lock:
+            entry = self.entries[protocol].get((kind, key))
+            return entry["last_seen"] if entry else None
+
+    def state(self, kind, key):
+        with self.lock:
+            state = {}
+            for protocol in self.protocols:
+                entry = self.entries[protocol].get((kind, key))
+                state["{}_connection".format(protocol)] = (
+                    entry is not None and entry["connected"]
+                )
+            return state
+
+    def disconnected(self, kind, protocol):
+        with self.lock:
+            return [
+                key
+                for (entrykind, key), entry in self.entries[protocol].items()
+                if entrykind == kind and not entry["connected"]
+            ]
+
+    def remove(self, kind, key):
+        with self.lock:
+            for protocol in self.protocols:
+                self.entries[protocol].pop((kind, key), None)
+
+    def clear(self):
+        with self.lock:
+            for protocol in self.protocols:
+                self.entries[protocol].clear()
 
-    # Will create the tables if they don't exist
-    db.table("users", cache_size=0)
-    db.table("clients", cache_size=0)
-    db.table("bots", cache_size=0)
-    db.table("tokens", cache_size=0)
 
-    return db
+presence = PresenceRegistry()
+
+
+def with_presence(kind, key, record):
+    # Adds the current connection state to a record read from the database
+    if record is not None:
+        record.update(presence.state(kind, record[key]))
+    return record
 
 
 class BumperUser(object):
@@ -95,133 +291,107 @@ def user_add(userid):
 
 
 def user_get(userid):
-    users = db_get().table("users")
-    User = Query()
-    return users.get(User.userid == userid)
+    return db_get().user_get(userid)
 
 
 def user_by_deviceid(deviceid):
-    users = db_get().table("users")
-    User = Query()
-    return users.get(User.devices.any([deviceid]))
+    return db_get().user_by_deviceid(deviceid)
 
 
 def user_full_upsert(user):
-    users = db_get().table("users")
-    User = Query()
-    users.upsert(user, User.did == user["userid"])
+    db_get().user_upsert(user)
 
 
 def user_add_device(userid, devid):
-    users = db_get().table("users")
-    User = Query()
-    user = users.get(User.userid == userid)
+    user = user_get(userid)
     userdevices = list(user["devices"])
     if not devid in userdevices:
         userdevices.append(devid)
-
-    users.upsert({"devices": userdevices}, User.userid == userid)
+        db_get().user_update(userid, {"devices": userdevices})
 
 
 def user_remove_device(userid, devid):
-    users = db_get().table("users")
-    User = Query()
-    user = users.get(User.userid == userid)
+    user = user_get(userid)
     userdevices = list(user["devices"])
     if devid in userdevices:
         userdevices.remove(devid)
 
-    users.upsert({"devices": userdevices}, User.userid == userid)
+    db_get().user_update(userid, {"devices": userdevices})
 
 
 def user_add_bot(userid, did):
-    users = db_get().table("users")
-    User = Query()
-    user = users.get(User.userid == userid)
+    user = user_get(userid)
     userbots = list(user["bots"])
     if not did in userbots:
         userbots.append(did)
 
-    users.upsert({"bots": userbots}, User.userid == userid)
+    db_get().user_update(userid, {"bots": userbots})
+
+
+def user_add_bots(userid, dids):
+    # Adds several bots with one write, or none if the user has them all
+    user = user_get(userid)
+    userbots = list(user["bots"])
+    known = set(userbots)
+    for did in dids:
+        if not did in known:
+            userbots.append(did)
+            known.add(did)
+
+    if len(userbots) != len(user["bots"]):
+        db_get().user_update(userid, {"bots": userbots})
 
 
 def user_remove_bot(userid, did):
-    users = db_get().table("users")
-    User = Query()
-    user = users.get(User.userid == userid)
+    user = user_get(userid)
     userbots = list(user["bots"])
     if did in userbots:
         userbots.remove(did)
 
-    users.upsert({"bots": userbots}, User.userid == userid)
+    db_get().user_update(userid, {"bots": userbots})
 
 
 def user_get_tokens(userid):
-    tokens = db_get().table("tokens")
-    return tokens.search((Query().userid == userid))
+    return db_get().token_get_by_userid(userid)
 
 
 def user_get_token(userid, token):
-    tokens = db_get().table("tokens")
-    return tokens.get((Query().userid == userid) & (Query().token == token))
+    return db_get().token_get(userid, token)
 
 
 def user_add_token(userid, token):
-    tokens = db_get().table("tokens")
-    tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
+    tmptoken = user_get_token(userid, token)
     if not tmptoken:
         bumperlog.debug("Adding token {} for userid {}".format(token, userid))
-        tokens.insert(
+        db_get().token_insert(
             {
                 "userid": userid,
                 "token": token,
-                "expiration": "{}".format(
-                    datetime.now() + timedelta(seconds=token_validity_seconds)
-                ),
+                "expiration": time.time() + token_validity_seconds,
             }
         )
 
 
 def user_revoke_all_tokens(userid):
-    tokens = db_get().table("tokens")
-    tsearch = tokens.search(Query().userid == userid)
-    for i in tsearch:
-        tokens.remove(doc_ids=[i.doc_id])
+    tsearch = user_get_tokens(userid)
+    db_get().token_remove([(i["userid"], i["token"]) for i in tsearch])
 
 
 def user_revoke_expired_tokens(userid):
-    tokens = db_get().table("tokens")
-    tsearch = tokens.search(Query().userid == userid)
-    for i in tsearch:
-        if datetime.now() >= datetime.fromisoformat(i["expiration"]):
-            bumperlog.debug("Removing token {} due to expiration".format(i["token"]))
-            tokens.remove(doc_ids=[i.doc_id])
+    for _, token in db_get().token_remove_expired(time.time(), userid):
+        bumperlog.debug("Removing token {} due to expiration".format(token))
 
 
 def user_revoke_token(userid, token):
-    tokens = db_get().table("tokens")
-    tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-    if tmptoken:
-        tokens.remove(doc_ids=[tmptoken.doc_id])
+    db_get().token_remove([(userid, token)])
 
 
 def user_add_authcode(userid, token, authcode):
-    tokens = db_get().table("tokens")
-    tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-    if tmptoken:
-        tokens.upsert(
-            {"authcode": authcode},
-            ((Query().userid == userid) & (Query().token == token)),
-        )
+    db_get().token_update(userid, token, {"authcode": authcode})
 
 
 def user_revoke_authcode(userid, token, authcode):
-    tokens = db_get().table("tokens")
-    tmptoken = tokens.get((Query().userid == userid) & (Query().token == token))
-    if tmptoken:
-        tokens.upsert(
-            {"authcode": ""}, ((Query().userid == userid) & (Query().token == token))
-        )
+    db_get().token_update(userid, token, {"authcode": ""})
 
 
 class VacBotDevice(object):
@@ -234,8 +404,6 @@ class VacBotDevice(object):
         self.name = name
         self.nick = nick
         self.resource = resource
-        self.mqtt_connection = False
-        self.xmpp_connection = False
 
     def asdict(self):
         return {
@@ -245,8 +413,6 @@ class VacBotDevice(object):
             "name": self.name,
             "nick": self.nick,
             "resource": self.resource,
-            "mqtt_connection": self.mqtt_connection,
-            "xmpp_connection": self.xmpp_connection,
         }
 
 
@@ -255,63 +421,50 @@ class VacBotClient(object):
         self.userid = userid
         self.realm = realm
         self.resource = token
-        self.mqtt_connection = False
-        self.xmpp_connection = False
 
     def asdict(self):
         return {
             "userid": self.userid,
             "realm": self.realm,
             "resource": self.resource,
-            "mqtt_connection": self.mqtt_connection,
-            "xmpp_connection": self.xmpp_connection,
         }
 
 
 def get_disconnected_xmpp_clients():
-    clients = db_get().table("clients")
-    Client = Query()
-    return clients.search(Client.xmpp_connection == False)
+    clients = []
+    for resource in presence.disconnected("clients", "xmpp"):
+        client = client_get(resource)
+        if client:
+            clients.append(client)
+    return clients
+
+
+def _token_matches_uid(token, uid):
+    # Userid with or without fuid_
+    return token["userid"] in (uid.replace("fuid_", ""), "fuid_{}".format(uid))
 
 
 def check_authcode(uid, authcode):
     bumperlog.debug("Checking for authcode: {}".format(authcode))
-    tokens = db_get().table("tokens")
-    tmpauth = tokens.get(
-        (Query().authcode == authcode)
-        & (  # Match authcode
-            (Query().userid == uid.replace("fuid_", ""))
-            | (Query().userid == "fuid_{}".format(uid))
-        )  # Userid with or without fuid_
-    )
-    if tmpauth:
-        return True
+    for tmpauth in db_get().token_get_by_authcode(authcode):
+        if _token_matches_uid(tmpauth, uid):
+            return True
 
     return False
 
 
 def check_token(uid, token):
     bumperlog.debug("Checking for token: {}".format(token))
-    tokens = db_get().table("tokens")
-    tmpauth = tokens.get(
-        (Query().token == token)
-        & (  # Match token
-            (Query().userid == uid.replace("fuid_", ""))
-            | (Query().userid == "fuid_{}".format(uid))
-        )  # Userid with or without fuid_
-    )
-    if tmpauth:
-        return True
+    for tmpauth in db_get().token_get_by_token(token):
+        if _token_matches_uid(tmpauth, uid):
+            return True
 
     return False
 
 
 def revoke_expired_tokens():
-    tokens = db_get().table("tokens").all()
-    for i in tokens:
-        if datetime.now() >= datetime.fromisoformat(i["expiration"]):
-            bumperlog.debug("Removing token {} due to expiration".format(i["token"]))
-            db_get().table("tokens").remove(doc_ids=[i.doc_id])
+    for _, token in db_get().token_remove_expired(time.time()):
+        bumperlog.debug("Removing token {} due to expiration".format(token))
 
 
 def bot_add(sn, did, devclass, resource, company):
@@ -331,39 +484,52 @@ def bot_add(sn, did, devclass, resource, company):
 
 
 def bot_remove(did):
-    bots = db_get().table("bots")
-    bot = bot_get(did)
-    bots.remove(doc_ids=[bot.doc_id])
+    db_get().bot_remove(did)
+    presence.remove("bots", did)
 
 
 def bot_get(did):
-    bots = db_get().table("bots")
-    Bot = Query()
-    return bots.get(Bot.did == did)
+    return with_presence("bots", "did", db_get().bot_get(did))
+
+
+def bot_get_all():
+    return [with_presence("bots", "did", bot) for bot in db_get().bot_get_all()]
+
+
+def bot_list(userid=None, fields=None, offset=0, limit=None):
+    # Bots of userid (or all bots) ordered by did, paginated with offset and
+    # limit and projected on fields. Returns (total, bots). Connection state is
+    # only looked up when fields ask for it.
+    dids = None
+    if userid is not None:
+        user = user_get(userid)
+        dids = user["bots"] if user else []
+
+    total, bots = db_get().bot_list(dids, offset, limit)
+
+    connection_fields = ["{}_connection".format(p) for p in presence.protocols]
+    if fields is None or any(field in connection_fields for field in fields):
+        bots = [with_presence("bots", "did", bot) for bot in bots]
+    if fields is not None:
+        bots = [{field: bot[field] for field in fields if field in bot} for bot in bots]
+
+    return total, bots
 
 
 def bot_full_upsert(vacbot):
-    bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert(vacbot, Bot.did == vacbot["did"])
+    db_get().bot_upsert(vacbot)
 
 
 def bot_set_nick(did, nick):
-    bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert({"nick": nick}, Bot.did == did)
+    db_get().bot_update(did, {"nick": nick})
 
 
 def bot_set_mqtt(did, mqtt):
-    bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert({"mqtt_connection": mqtt}, Bot.did == did)
+    presence.set("bots", did, "mqtt", mqtt)
 
 
 def bot_set_xmpp(did, xmpp):
-    bots = db_get().table("bots")
-    Bot = Query()
-    bots.upsert({"xmpp_connection": xmpp}, Bot.did == did)
+    presence.set("bots", did, "xmpp", xmpp)
 
 
 def client_add(userid, realm, resource):
@@ -379,27 +545,62 @@ def client_add(userid, realm, resource):
 
 
 def client_get(resource):
-    clients = db_get().table("clients")
-    Client = Query()
-    return clients.get(Client.resource == resource)
+    return with_presence("clients", "resource", db_get().client_get(resource))
 
 
 def client_full_upsert(client):
-    clients = db_get().table("clients")
-    Client = Query()
-    clients.upsert(client, Client.resource == client["resource"])
+    db_get().client_upsert(client)
 
 
 def client_set_mqtt(resource, mqtt):
-    clients = db_get().table("clients")
-    Client = Query()
-    clients.upsert({"mqtt_connection": mqtt}, Client.resource == resource)
+    presence.set("clients", resource, "mqtt", mqtt)
 
 
 def client_set_xmpp(resource, xmpp):
-    clients = db_get().table("clients")
-    Client = Query()
-    clients.upsert({"xmpp_connection": xmpp}, Client.resource == resource)
+    presence.set("clients", resource, "xmpp", xmpp)
+
+
+async def db_run(func, *args):
+    # Runs a blocking storage function off the calling event loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+
+def db_async(func):
+    async def run(*args):
+        return await db_run(func, *args)
+
+    run.__name__ = "{}_async".format(func.__name__)
+    return run
+
+
+# Async variants of the storage helpers, for use from coroutines
+user_add_async = db_async(user_add)
+user_get_async = db_async(user_get)
+user_by_deviceid_async = db_async(user_by_deviceid)
+user_add_device_async = db_async(user_add_device)
+user_remove_device_async = db_async(user_remove_device)
+user_add_bot_async = db_async(user_add_bot)
+user_add_bots_async = db_async(user_add_bots)
+user_remove_bot_async = db_async(user_remove_bot)
+user_get_tokens_async = db_async(user_get_tokens)
+user_get_token_async = db_async(user_get_token)
+user_add_token_async = db_async(user_add_token)
+user_revoke_all_tokens_async = db_async(user_revoke_all_tokens)
+user_revoke_expired_tokens_async = db_async(user_revoke_expired_tokens)
+user_revoke_token_async = db_async(user_revoke_token)
+user_add_authcode_async = db_async(user_add_authcode)
+user_revoke_authcode_async = db_async(user_revoke_authcode)
+check_authcode_async = db_async(check_authcode)
+check_token_async = db_async(check_token)
+bot_add_async = db_async(bot_add)
+bot_remove_async = db_async(bot_remove)
+bot_get_async = db_async(bot_get)
+bot_get_all_async = db_async(bot_get_all)
+bot_list_async = db_async(bot_list)
+bot_set_nick_async = db_async(bot_set_nick)
+client_add_async = db_async(client_add)
+client_get_async = db_async(client_get)
 
 
 RETURN_API_SUCCESS = "0000"
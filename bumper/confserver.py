@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from threading import Thread
-import socket, logging, ssl, json
+import logging, json
 import string
 import random
 import bumper
@@ -9,7 +9,10 @@ import time
 from datetime import datetime, timedelta
 import asyncio
 import contextvars
-from aiohttp import web
+import multiprocessing
+import signal
+import aiohttp
+from aiohttp import hdrs, web
 import uuid
 
 
@@ -36,14 +39,240 @@ logging.getLogger("asyncio").setLevel(logging.CRITICAL + 1)  # Ignore this logge
 logging.getLogger("aiohttp.access").addFilter(aiohttp_filter())
 
 
+class ResponseTemplate(object):
+    # JSON response serialized once, with only the top level "time" field
+    # filled in per request
+
+    TIME = "__bumper_time__"
+
+    def __init__(self, body):
+        if "time" in body:
+            body = dict(body, time=self.TIME)
+        text = json.dumps(body)
+        self.parts = [part.encode() for part in text.split(json.dumps(self.TIME))]
+
+    def render(self):
+        if len(self.parts) == 1:
+            return self.parts[0]
+        now = str(bumper.get_milli_time(datetime.utcnow().timestamp())).encode()
+        return now.join(self.parts)
+
+    def response(self):
+        return web.Response(
+            body=self.render(), content_type="application/json", charset="utf-8"
+        )
+
+
+PRIVATE_API = "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}"
+
+
+def response_templates():
+    # Built per ConfServer rather than at import, the error codes live in
+    # bumper which imports this module
+    return {
+        "loginFailed": ResponseTemplate(
+            {
+                "code": bumper.ERR_USER_NOT_ACTIVATED,
+                "data": None,
+                "msg": "当前密码错误",
+                "time": 0,
+            }
+        ),
+        "tokenInvalid": ResponseTemplate(
+            {"code": bumper.ERR_TOKEN_INVALID, "data": None, "msg": "当前密码错误", "time": 0}
+        ),
+        "logout": ResponseTemplate(
+            {"code": bumper.RETURN_API_SUCCESS, "data": None, "msg": "操作成功", "time": 0}
+        ),
+        "checkVersion": ResponseTemplate(
+            {
+                "code": bumper.RETURN_API_SUCCESS,
+                "data": {
+                    "c": None,
+                    "img": None,
+                    "r": 0,
+                    "t": None,
+                    "u": None,
+                    "ut": 0,
+                    "v": None,
+                },
+                "msg": "操作成功",
+                "time": 0,
+            }
+        ),
+        "checkAgreement": ResponseTemplate(
+            {"code": bumper.RETURN_API_SUCCESS, "data": [], "msg": "操作成功", "time": 0}
+        ),
+        "getProductIotMap": ResponseTemplate(
+            {
+                "code": bumper.RETURN_API_SUCCESS,
+                "data": [
+                    {
+                        "classid": "dl8fht",
+                        "product": {
+                            "_id": "5acb0fa87c295c0001876ecf",
+                            "name": "DEEBOT 600 Series",
+                            "icon": "5acc32067c295c0001876eea",
+                            "UILogicId": "dl8fht",
+                            "ota": False,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5acc32067c295c0001876eea",
+                        },
+                    },
+                    {
+                        "classid": "02uwxm",
+                        "product": {
+                            "_id": "5ae1481e7ccd1a0001e1f69e",
+                            "name": "DEEBOT OZMO Slim10 Series",
+                            "icon": "5b1dddc48bc45700014035a1",
+                            "UILogicId": "02uwxm",
+                            "ota": False,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b1dddc48bc45700014035a1",
+                        },
+                    },
+                    {
+                        "classid": "y79a7u",
+                        "product": {
+                            "_id": "5b04c0227ccd1a0001e1f6a8",
+                            "name": "DEEBOT OZMO 900",
+                            "icon": "5b04c0217ccd1a0001e1f6a7",
+                            "UILogicId": "y79a7u",
+                            "ota": True,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b04c0217ccd1a0001e1f6a7",
+                        },
+                    },
+                    {
+                        "classid": "jr3pqa",
+                        "product": {
+                            "_id": "5b43077b8bc457000140363e",
+                            "name": "DEEBOT 711",
+                            "icon": "5b5ac4cc8d5a56000111e769",
+                            "UILogicId": "jr3pqa",
+                            "ota": True,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b5ac4cc8d5a56000111e769",
+                        },
+                    },
+                    {
+                        "classid": "uv242z",
+                        "product": {
+                            "_id": "5b5149b4ac0b87000148c128",
+                            "name": "DEEBOT 710",
+                            "icon": "5b5ac4e45f21100001882bb9",
+                            "UILogicId": "uv242z",
+                            "ota": True,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b5ac4e45f21100001882bb9",
+                        },
+                    },
+                    {
+                        "classid": "ls1ok3",
+                        "product": {
+                            "_id": "5b6561060506b100015c8868",
+                            "name": "DEEBOT 900 Series",
+                            "icon": "5ba4a2cb6c2f120001c32839",
+                            "UILogicId": "ls1ok3",
+                            "ota": True,
+                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5ba4a2cb6c2f120001c32839",
+                        },
+                    },
+                ],
+            }
+        ),
+    }
+
+
+# Bumper settings copied into worker processes, which start from a fresh import
+WORKER_SETTINGS = (
+    "ca_cert",
+    "server_cert",
+    "server_key",
+    "use_auth",
+    "token_validity_seconds",
+    "db",
+    "db_engine",
+    "server_ip",
+    "server_address_resolved",
+)
+
+
+def start_conf_workers(listeners, count, forward_to):
+    # Starts count processes that all serve the (address, usessl) listeners,
+    # the kernel spreads connections over them with SO_REUSEPORT. Bot commands
+    # go to forward_to, a ConfServer in the process running the helper bot.
+    # Each worker loads its own TLS context, the ssl module can't share ticket
+    # keys or the session cache between processes. A resumption that lands on
+    # another worker is a full handshake, each worker logs its own counters.
+    settings = {name: getattr(bumper, name) for name in WORKER_SETTINGS}
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    for i in range(count):
+        worker = ctx.Process(
+            name="ConfServer_Worker_{}".format(i),
+            target=run_conf_worker,
+            args=(listeners, forward_to, settings, logging.getLogger().level),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def log_handshake_stats(loop, interval):
+    # Handshakes on this worker's TLS context, every interval seconds
+    bumper.bumperlog.debug("TLS handshakes: {}".format(bumper.ssl_handshake_stats()))
+    loop.call_later(interval, log_handshake_stats, loop, interval)
+
+
+def run_conf_worker(listeners, forward_to, settings, loglevel):
+    logging.basicConfig(
+        level=loglevel,
+        format="[%(asctime)s] :: %(levelname)s :: %(processName)s :: %(name)s :: %(message)s",
+    )
+    for name, value in settings.items():
+        setattr(bumper, name, value)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if hasattr(signal, "SIGHUP"):
+        # Workers answer FindBest, each refreshes its own announced address
+        loop.add_signal_handler(signal.SIGHUP, bumper.refresh_server_address)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)  # Clean up on terminate()
+
+    servers = []
+    for address, usessl in listeners:
+        server = ConfServer(address, usessl, forward_to=forward_to, reuse_port=True)
+        server.confserver_app()
+        loop.run_until_complete(server.start_server())
+        servers.append(server)
+
+    log_handshake_stats(loop, 30)  # Same period as the checks in start_bumper
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            if server.runner is not None:
+                # Closes the forwarding session through on_cleanup
+                loop.run_until_complete(server.runner.cleanup())
+        bumper.db_close()
+
+
 class ConfServer:
-    def __init__(self, address, usessl=False, helperbot=None):
+    def __init__(
+        self, address, usessl=False, helperbot=None, forward_to=None, reuse_port=False
+    ):
         self.helperbot = helperbot
         self.usessl = usessl
         self.address = address
+        self.forward_to = forward_to  # Address bot commands are forwarded to
+        self.forward_session = None
+        self.runner = None
+        self.reuse_port = reuse_port  # Share the port with worker processes
         self.confthread = None
         self.run_async = False
         self.app = None
+        self.templates = response_templates()
+        self.msgserver = None  # (address, lookup.do body), see lookup_msgserver()
 
     def run(self, run_async=False):
         try:
@@ -83,38 +312,20 @@ class ConfServer:
 
     def confserver_app(self):
         self.app = web.Application()
+        self.app.on_cleanup.append(self.close_forward_session)
+        self.private_routes = {
+            "user/login": self.handle_login,
+            "user/checkLogin": self.handle_login,
+            "user/logout": self.handle_logout,
+            "user/getAuthCode": self.handle_getAuthCode,
+            "user/checkAgreement": self.handle_checkAgreement,
+            "common/checkVersion": self.handle_checkVersion,
+            "campaign/homePageAlert": self.handle_homePageAlert,
+        }
 
         self.app.add_routes(
             [
                 web.get("", self.handle_base),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/login",
-                    self.handle_login,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/checkLogin",
-                    self.handle_login,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/logout",
-                    self.handle_logout,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/getAuthCode",
-                    self.handle_getAuthCode,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/checkAgreement",
-                    self.handle_checkAgreement,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/common/checkVersion",
-                    self.handle_checkVersion,
-                ),
-                web.get(
-                    "/{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/campaign/homePageAlert",
-                    self.handle_homePageAlert,
-                ),
                 web.post("/api/users/user.do", self.handle_usersapi),
                 web.get("/api/users/user.do", self.handle_usersapi),
                 web.post(
@@ -122,8 +333,12 @@ class ConfServer:
                 ),
                 web.post("/api/iot/devmanager.do", self.handle_devmanager_botcommand),
                 web.post("/lookup.do", self.handle_lookup),
+                # One route for the private API, endpoints are looked up in
+                # private_routes instead of matching a route each
+                web.get(PRIVATE_API + "/{endpoint:.+}", self.handle_private),
             ]
         )
+
         # Direct register from app:
         # /{apiversion}/private/{country}/{language}/{devid}/{apptype}/{appversion}/{devtype}/{aid}/user/directRegister
 
@@ -131,19 +346,24 @@ class ConfServer:
         try:
             runner = web.AppRunner(self.app)
             await runner.setup()
+            self.runner = runner
 
             if self.usessl:
-                ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                ssl_ctx.load_cert_chain(bumper.server_cert, bumper.server_key)
                 site = web.TCPSite(
                     runner,
                     host=self.address[0],
                     port=self.address[1],
-                    ssl_context=ssl_ctx,
+                    ssl_context=bumper.ssl_server_context(),
+                    reuse_port=self.reuse_port,
                 )
 
             else:
-                site = web.TCPSite(runner, host=self.address[0], port=self.address[1])
+                site = web.TCPSite(
+                    runner,
+                    host=self.address[0],
+                    port=self.address[1],
+                    reuse_port=self.reuse_port,
+                )
 
             await site.start()
 
@@ -160,6 +380,12 @@ class ConfServer:
             confserverlog.exception("{}".format(e))
             exit(1)
 
+    async def handle_private(self, request):
+        handler = self.private_routes.get(request.match_info["endpoint"])
+        if handler is None:
+            raise web.HTTPNotFound()
+        return await handler(request)
+
     async def handle_base(self, request):
         try:
             # TODO - API Options here for viewing clients, tokens, restarting the server, etc.
@@ -181,19 +407,19 @@ class ConfServer:
                 if (
                     not user_devid == ""
                 ):  # Performing basic "auth" using devid, super insecure
-                    user = bumper.user_by_deviceid(user_devid)
+                    user = await bumper.user_by_deviceid_async(user_devid)
                     if "checkLogin" in request.path:
-                        self.check_token(
+                        await self.check_token(
                             countrycode, user, request.query["accessToken"]
                         )
                     else:
                         # Deactivate old tokens and authcodes
-                        bumper.user_revoke_expired_tokens(user["userid"])
+                        await bumper.user_revoke_expired_tokens_async(user["userid"])
 
                         body = {
                             "code": bumper.RETURN_API_SUCCESS,
                             "data": {
-                                "accessToken": self.generate_token(
+                                "accessToken": await self.generate_token(
                                     user
                                 ),  # generate a new token
                                 "country": countrycode,
@@ -208,25 +434,18 @@ class ConfServer:
                         }
                         return web.json_response(body)
 
-                body = {
-                    "code": bumper.ERR_USER_NOT_ACTIVATED,
-                    "data": None,
-                    "msg": "当前密码错误",
-                    "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-                }
-
-                return web.json_response(body)
+                return self.templates["loginFailed"].response()
 
             else:
                 return web.json_response(
-                    self._auth_any(user_devid, countrycode, request)
+                    await self._auth_any(user_devid, countrycode, request)
                 )
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
 
-    def check_token(self, countrycode, user, token):
-        if bumper.check_token(user["userid"], token):
+    async def check_token(self, countrycode, user, token):
+        if await bumper.check_token_async(user["userid"], token):
             body = {
                 "code": bumper.RETURN_API_SUCCESS,
                 "data": {
@@ -242,44 +461,40 @@ class ConfServer:
             return web.json_response(body)
 
         else:
-            body = {
-                "code": bumper.ERR_TOKEN_INVALID,
-                "data": None,
-                "msg": "当前密码错误",
-                "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-            }
-            return web.json_response(body)
+            return self.templates["tokenInvalid"].response()
 
-    def generate_token(self, user):
+    async def generate_token(self, user):
         tmpaccesstoken = uuid.uuid4().hex
-        bumper.user_add_token(user["userid"], tmpaccesstoken)
+        await bumper.user_add_token_async(user["userid"], tmpaccesstoken)
         return tmpaccesstoken
 
-    def generate_authcode(self, user, countrycode, token):
+    async def generate_authcode(self, user, countrycode, token):
         tmpauthcode = "{}_{}".format(countrycode, uuid.uuid4().hex)
-        bumper.user_add_authcode(user["userid"], token, tmpauthcode)
+        await bumper.user_add_authcode_async(user["userid"], token, tmpauthcode)
         return tmpauthcode
 
-    def _auth_any(self, devid, country, request):
+    async def _auth_any(self, devid, country, request):
         try:
             user_devid = devid
             countrycode = country
-            user = bumper.user_by_deviceid(user_devid)
-            bots = bumper.db_get().table("bots").all()
+            user = await bumper.user_by_deviceid_async(user_devid)
+            _, bots = await bumper.bot_list_async(None, ["did"])
 
             if user:  # Default to user 0
                 tmpuser = user
-                bumper.user_add_device(tmpuser["userid"], user_devid)
+                await bumper.user_add_device_async(tmpuser["userid"], user_devid)
             else:
-                bumper.user_add("tmpuser")  # Add a new user
-                tmpuser = bumper.user_get("tmpuser")
-                bumper.user_add_device(tmpuser["userid"], user_devid)
+                await bumper.user_add_async("tmpuser")  # Add a new user
+                tmpuser = await bumper.user_get_async("tmpuser")
+                await bumper.user_add_device_async(tmpuser["userid"], user_devid)
 
-            for bot in bots:  # Add all bots to the user
-                bumper.user_add_bot(tmpuser["userid"], bot["did"])
+            # Add all bots to the user, in one write
+            await bumper.user_add_bots_async(
+                tmpuser["userid"], [bot["did"] for bot in bots]
+            )
 
             if "checkLogin" in request.path:  # If request was to check a token do so
-                checkToken = self.check_token(
+                checkToken = await self.check_token(
                     countrycode, tmpuser, request.query["accessToken"]
                 )
                 isGood = json.loads(checkToken.text)
@@ -287,12 +502,14 @@ class ConfServer:
                     return isGood
 
             # Deactivate old tokens and authcodes
-            bumper.user_revoke_expired_tokens(tmpuser["userid"])
+            await bumper.user_revoke_expired_tokens_async(tmpuser["userid"])
 
             body = {
                 "code": bumper.RETURN_API_SUCCESS,
                 "data": {
-                    "accessToken": self.generate_token(tmpuser),  # Generate a token
+                    "accessToken": await self.generate_token(
+                        tmpuser
+                    ),  # Generate a token
                     "country": countrycode,
                     "email": "null@null.com",
                     "uid": "fuid_{}".format(tmpuser["userid"]),
@@ -311,22 +528,17 @@ class ConfServer:
         try:
             user_devid = request.match_info.get("devid", "")
             if not user_devid == "":
-                user = bumper.user_by_deviceid(user_devid)
+                user = await bumper.user_by_deviceid_async(user_devid)
                 if user:
-                    if bumper.check_token(user["userid"], request.query["accessToken"]):
+                    if await bumper.check_token_async(
+                        user["userid"], request.query["accessToken"]
+                    ):
                         # Deactivate old tokens and authcodes
-                        bumper.user_revoke_token(
+                        await bumper.user_revoke_token_async(
                             user["userid"], request.query["accessToken"]
                         )
 
-            body = {
-                "code": bumper.RETURN_API_SUCCESS,
-                "data": None,
-                "msg": "操作成功",
-                "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-            }
-
-            return web.json_response(body)
+            return self.templates["logout"].response()
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
@@ -336,15 +548,15 @@ class ConfServer:
 
             user_devid = request.match_info.get("devid", "")
             if not user_devid == "":
-                user = bumper.user_by_deviceid(user_devid)
+                user = await bumper.user_by_deviceid_async(user_devid)
                 if user:
-                    token = bumper.user_get_token(
+                    token = await bumper.user_get_token_async(
                         user["userid"], request.query["accessToken"]
                     )
                     if token:
                         authcode = ""
                         if not "authcode" in token:
-                            authcode = self.generate_authcode(
+                            authcode = await self.generate_authcode(
                                 user,
                                 request.match_info.get("country", "us"),
                                 request.query["accessToken"],
@@ -365,50 +577,21 @@ class ConfServer:
                         }
                         return web.json_response(body)
 
-            body = {
-                "code": bumper.ERR_TOKEN_INVALID,
-                "data": None,
-                "msg": "当前密码错误",
-                "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-            }
-
-            return web.json_response(body)
+            return self.templates["tokenInvalid"].response()
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
 
     async def handle_checkVersion(self, request):
         try:
-            body = {
-                "code": bumper.RETURN_API_SUCCESS,
-                "data": {
-                    "c": None,
-                    "img": None,
-                    "r": 0,
-                    "t": None,
-                    "u": None,
-                    "ut": 0,
-                    "v": None,
-                },
-                "msg": "操作成功",
-                "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-            }
-
-            return web.json_response(body)
+            return self.templates["checkVersion"].response()
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
 
     async def handle_checkAgreement(self, request):
         try:
-            body = {
-                "code": bumper.RETURN_API_SUCCESS,
-                "data": [],
-                "msg": "操作成功",
-                "time": bumper.get_milli_time(datetime.utcnow().timestamp()),
-            }
-
-            return web.json_response(body)
+            return self.templates["checkAgreement"].response()
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
@@ -440,78 +623,7 @@ class ConfServer:
 
     async def handle_getProductIotMap(self, request):
         try:
-            body = {
-                "code": bumper.RETURN_API_SUCCESS,
-                "data": [
-                    {
-                        "classid": "dl8fht",
-                        "product": {
-                            "_id": "5acb0fa87c295c0001876ecf",
-                            "name": "DEEBOT 600 Series",
-                            "icon": "5acc32067c295c0001876eea",
-                            "UILogicId": "dl8fht",
-                            "ota": False,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5acc32067c295c0001876eea",
-                        },
-                    },
-                    {
-                        "classid": "02uwxm",
-                        "product": {
-                            "_id": "5ae1481e7ccd1a0001e1f69e",
-                            "name": "DEEBOT OZMO Slim10 Series",
-                            "icon": "5b1dddc48bc45700014035a1",
-                            "UILogicId": "02uwxm",
-                            "ota": False,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b1dddc48bc45700014035a1",
-                        },
-                    },
-                    {
-                        "classid": "y79a7u",
-                        "product": {
-                            "_id": "5b04c0227ccd1a0001e1f6a8",
-                            "name": "DEEBOT OZMO 900",
-                            "icon": "5b04c0217ccd1a0001e1f6a7",
-                            "UILogicId": "y79a7u",
-                            "ota": True,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b04c0217ccd1a0001e1f6a7",
-                        },
-                    },
-                    {
-                        "classid": "jr3pqa",
-                        "product": {
-                            "_id": "5b43077b8bc457000140363e",
-                            "name": "DEEBOT 711",
-                            "icon": "5b5ac4cc8d5a56000111e769",
-                            "UILogicId": "jr3pqa",
-                            "ota": True,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b5ac4cc8d5a56000111e769",
-                        },
-                    },
-                    {
-                        "classid": "uv242z",
-                        "product": {
-                            "_id": "5b5149b4ac0b87000148c128",
-                            "name": "DEEBOT 710",
-                            "icon": "5b5ac4e45f21100001882bb9",
-                            "UILogicId": "uv242z",
-                            "ota": True,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5b5ac4e45f21100001882bb9",
-                        },
-                    },
-                    {
-                        "classid": "ls1ok3",
-                        "product": {
-                            "_id": "5b6561060506b100015c8868",
-                            "name": "DEEBOT 900 Series",
-                            "icon": "5ba4a2cb6c2f120001c32839",
-                            "UILogicId": "ls1ok3",
-                            "ota": True,
-                            "iconUrl": "https://portal-ww.ecouser.net/api/pim/file/get/5ba4a2cb6c2f120001c32839",
-                        },
-                    },
-                ],
-            }
-            return web.json_response(body)
+            return self.templates["getProductIotMap"].response()
 
         except Exception as e:
             confserverlog.exception("{}".format(e))
@@ -529,19 +641,28 @@ class ConfServer:
                     postbody = json.loads(await request.text())
 
                 todo = postbody["todo"]
+                if todo in ("GetDeviceList", "DeleteOneDevice") and self.forward_to:
+                    # Connection state is only known to the owning process, and
+                    # removing a bot has to clear it there
+                    return await self.forward_request(
+                        request, {"result": "fail", "todo": "result"}
+                    )
+
                 if todo == "FindBest":
                     service = postbody["service"]
                     if service == "EcoMsgNew":
                         body = {
                             "result": "ok",
-                            "ip": socket.gethostbyname(socket.gethostname()),
+                            "ip": bumper.server_address(),
                             "port": 5223,
                         }
                     elif service == "EcoUpdate":
                         body = {"result": "ok", "ip": "47.88.66.164", "port": 8005}
 
                 elif todo == "loginByItToken":
-                    if bumper.check_authcode(postbody["userId"], postbody["token"]):
+                    if await bumper.check_authcode_async(
+                        postbody["userId"], postbody["token"]
+                    ):
                         body = {
                             "resource": postbody["resource"],
                             "result": "ok",
@@ -551,22 +672,26 @@ class ConfServer:
                         }
 
                 elif todo == "GetDeviceList":
-                    body = {
-                        "devices": bumper.db_get().table("bots").all(),
-                        "result": "ok",
-                        "todo": "result",
-                    }
+                    total, devices = await bumper.bot_list_async(
+                        self.device_list_owner(postbody),
+                        postbody.get("fields"),  # All, with connection state
+                        int(postbody.get("offset", 0)),
+                        int(postbody["limit"]) if "limit" in postbody else None,
+                    )
+                    body = {"devices": devices, "result": "ok", "todo": "result"}
+                    if "limit" in postbody:
+                        body["total"] = total
 
                 elif todo == "SetDeviceNick":
-                    bumper.bot_set_nick(postbody["did"], postbody["nick"])
+                    await bumper.bot_set_nick_async(postbody["did"], postbody["nick"])
                     body = {"result": "ok", "todo": "result"}
 
                 elif todo == "AddOneDevice":
-                    bumper.bot_set_nick(postbody["did"], postbody["nick"])
+                    await bumper.bot_set_nick_async(postbody["did"], postbody["nick"])
                     body = {"result": "ok", "todo": "result"}
 
                 elif todo == "DeleteOneDevice":
-                    bumper.bot_remove(postbody["did"])
+                    await bumper.bot_remove_async(postbody["did"])
                     body = {"result": "ok", "todo": "result"}
 
                 confserverlog.debug(
@@ -582,6 +707,14 @@ class ConfServer:
         body = {"result": "fail", "todo": "result"}
         return web.json_response(body)
 
+    def device_list_owner(self, postbody):
+        # Apps send their userid with every request and must see every bot, so
+        # only an explicit "owner" (userid, or fuid_... as from login) filters
+        owner = postbody.get("owner")
+        if owner is not None and owner.startswith("fuid_"):
+            owner = owner[len("fuid_") :]
+        return owner
+
     async def handle_lookup(self, request):
         try:
 
@@ -599,18 +732,13 @@ class ConfServer:
             if todo == "FindBest":
                 service = postbody["service"]
                 if service == "EcoMsgNew":
-
-                    srvip = socket.gethostbyname(socket.gethostname())
-                    msgserver = {"ip": srvip, "port": 5223, "result": "ok"}
-                    msgserver = json.dumps(msgserver)
-                    msgserver = msgserver.replace(
-                        " ", ""
-                    )  # bot seems to be very picky about having no spaces, only way was with text
-
+                    msgserver = self.lookup_msgserver()
                     confserverlog.debug(
                         "\r\n POST: {} \r\n Response: {}".format(postbody, msgserver)
                     )
-                    return web.json_response(text=msgserver)
+                    return web.Response(
+                        body=msgserver, content_type="application/json", charset="utf-8"
+                    )
 
                 elif service == "EcoUpdate":
                     body = {"result": "ok", "ip": "47.88.66.164", "port": 8005}
@@ -623,15 +751,68 @@ class ConfServer:
         except Exception as e:
             confserverlog.exception("{}".format(e))
 
+    def lookup_msgserver(self):
+        # Bot seems to be very picky about having no spaces, the compact body
+        # is rendered once per announced address
+        srvip = bumper.server_address()
+        if self.msgserver is None or self.msgserver[0] != srvip:
+            msgserver = {"ip": srvip, "port": 5223, "result": "ok"}
+            text = json.dumps(msgserver, separators=(",", ":"))
+            self.msgserver = (srvip, text.encode())
+        return self.msgserver[1]
+
+    async def forward_request(self, request, failbody):
+        # Bot connections, presence and the helper bot live in the owning
+        # process. failbody is returned if it can't be reached.
+        try:
+            if self.forward_session is None:
+                self.forward_session = aiohttp.ClientSession()
+
+            url = "http://{}:{}{}".format(
+                self.forward_to[0], self.forward_to[1], request.rel_url
+            )
+            async with self.forward_session.post(
+                url,
+                data=await request.read(),
+                headers={
+                    hdrs.CONTENT_TYPE: request.headers.get(
+                        hdrs.CONTENT_TYPE, "application/json"
+                    )
+                },
+            ) as resp:
+                return web.Response(
+                    body=await resp.read(),
+                    status=resp.status,
+                    content_type=resp.content_type,
+                )
+
+        except Exception as e:
+            confserverlog.exception(
+                "Error forwarding {} to {} - {}".format(request.path, self.forward_to, e)
+            )
+            return web.json_response(failbody)
+
+    async def close_forward_session(self, app):
+        if self.forward_session is not None:
+            await self.forward_session.close()
+            self.forward_session = None
+
     async def handle_devmanager_botcommand(self, request):
+        if self.forward_to:
+            return await self.forward_request(
+                request, {"errno": bumper.ERR_COMMON, "ret": "fail"}
+            )
+
         try:
             json_body = json.loads(await request.text())
             confserverlog.debug("BotCommand: {}".format(json_body))
             randomid = "".join(random.sample(string.ascii_letters, 6))
 
             if "toId" in json_body:  # Its a command
-                bot = bumper.bot_get(json_body["toId"])
-                if bot["company"] == "eco-ng" and bot["mqtt_connection"] == True:
+                bot = await bumper.bot_get_async(json_body["toId"])
+                if bot["company"] == "eco-ng" and bumper.presence.is_connected(
+                    "bots", bot["did"], "mqtt"
+                ):
                     retcmd = await self.helperbot.send_command(json_body, randomid)
                     body = retcmd
                     confserverlog.debug(
@@ -8,13 +8,11 @@ from hbmqtt.broker import Broker
 from hbmqtt.client import MQTTClient
 from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
 import pkg_resources
-import contextvars
-import time
 from threading import Thread
 import ssl
 import bumper
 import json
-from datetime import datetime, timedelta
+from collections import OrderedDict
 
 helperbotlog = logging.getLogger("helperbot")
 mqttserverlog = logging.getLogger("mqttserver")
@@ -30,18 +28,49 @@ logging.getLogger("hbmqtt.mqtt.protocol").setLevel(
 logging.getLogger("hbmqtt.client").setLevel(logging.CRITICAL + 1)  # Ignore this logger
 
 
+class ResponseStats:
+    # Counts bot responses that no command was waiting for. Remembers the
+    # last capacity timed out request ids to tell late responses apart
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.timeouts = OrderedDict()  # Recently timed out request ids
+        self.stats = {"unmatched": 0, "late": 0}
+
+    def timed_out(self, requestid):
+        self.timeouts[requestid] = None
+        if len(self.timeouts) > self.capacity:
+            self.timeouts.popitem(last=False)
+
+    def add(self, requestid):
+        if self.timeouts.pop(requestid, False) is None:
+            self.stats["late"] += 1  # The command already gave up waiting
+        self.stats["unmatched"] += 1
+
+
 class MQTTHelperBot:
 
     Client = MQTTClient()
 
     def __init__(
         self,
-        address
+        address,
+        response_capacity=100
     ):
         self.address = address
         self.client_id = "helper1@bumper/helper1"
-        self.command_responses = contextvars.ContextVar("command_responses", default=[])
+        # Only touched from the helper bot loop, see send_command()
+        self.response_stats = ResponseStats(response_capacity)
+        self.pending_responses = {}  # requestid -> Future awaiting the bot response
+        self.command_timeout = 10  # Seconds to wait for a bot response
+        # Identical read-only commands share one round trip, and their results
+        # are reused for result_ttl seconds, see _send_command()
+        self.inflight_commands = {}  # (toId, cmdName, payload) -> Task
+        self.command_results = {}  # (toId, cmdName, payload) -> (expires, resp)
+        self.result_ttl = bumper.helperbot_result_ttl
+        self.command_stats = {"sent": 0, "coalesced": 0, "cached": 0}
         self.helperthread = None
+        self.loop = None
 
     def run(self, run_async=False):
         if run_async:
@@ -61,6 +90,7 @@ class MQTTHelperBot:
         print("Starting MQTT HelperBot")
         try:
             asyncio.set_event_loop(loop)
+            self.loop = loop
             self.Client = MQTTClient(
                 client_id=self.client_id, config={"check_hostname": False}
             )
@@ -93,62 +123,114 @@ class MQTTHelperBot:
                 message = await self.Client.deliver_message()
 
                 # helperbotlog.debug("HelperBot MQTT Received Message on Topic: {} - Message: {}".format(message.topic, str(message.payload.decode("utf-8"))))
-                cresp = self.command_responses.get()
-
-                if str(message.topic).split("/")[6] == "helper1":
-                    cresp.append(
-                        {
-                            "time": time.time(),
-                            "topic": message.topic,
-                            "payload": str(message.data.decode("utf-8")),
-                        }
-                    )
-
-                # Cleanup "expired messages" > 60 seconds from time
-                for msg in cresp:
-                    expire_time = (
-                        datetime.fromtimestamp(msg["time"]) + timedelta(seconds=10)
-                    ).timestamp()
-                    if time.time() > expire_time:
-                        # helperbotlog.debug("Pruning Message Time: {}, MsgTime: {}, MsgTime+60: {}".format(time.time(), msg['time'], expire_time))
-                        cresp.remove(msg)
-
-                self.command_responses.set(cresp)
-                # helperbotlog.debug("MQTT Command Response List Count: %s" %len(cresp))
+                topic = str(message.topic).split("/")
+                if topic[6] == "helper1":
+                    payload = str(message.data.decode("utf-8"))
+                    future = self.pending_responses.pop(topic[10], None)
+                    if future:
+                        self._resolve_response(future, topic, payload)
+                        continue
+
+                    # No command waiting, only count it
+                    self.response_stats.add(topic[10])
+                    # helperbotlog.debug("MQTT Unmatched Responses: {}".format(self.response_stats.stats))
 
         except Exception as e:
             helperbotlog.exception("{}".format(e))
 
+    def _resolve_response(self, future, topic, payload):
+        if future.done():
+            return
+
+        # helperbotlog.debug('VacBot MQTT Response: Topic: %s Payload: %s' % ("/".join(topic), payload))
+        if topic[11] == "j":
+            resppayload = json.loads(payload)
+        else:
+            resppayload = payload
+        future.set_result({"id": topic[10], "ret": "ok", "resp": resppayload})
+
     async def wait_for_resp(self, requestid):
         try:
+            return await asyncio.wait_for(
+                self.pending_responses[requestid], timeout=self.command_timeout
+            )
 
-            t_end = (datetime.now() + timedelta(seconds=10)).timestamp()
-
-            while time.time() < t_end:
-                await asyncio.sleep(0.1)
-                responses = self.command_responses.get()
-                if len(responses) > 0:
-                    for msg in responses:
-                        topic = str(msg["topic"]).split("/")
-                        if topic[6] == "helper1" and topic[10] == requestid:
-                            # helperbotlog.debug('VacBot MQTT Response: Topic: %s Payload: %s' % (msg['topic'], msg['payload']))
-                            if topic[11] == "j":
-                                resppayload = json.loads(msg["payload"])
-                            else:
-                                resppayload = str(msg["payload"])
-                            resp = {"id": requestid, "ret": "ok", "resp": resppayload}
-                            cresp = self.command_responses.get()
-                            cresp.remove(msg)
-                            self.command_responses.set(cresp)
-                            return resp
-
+        except asyncio.TimeoutError:
+            self.response_stats.timed_out(requestid)
             return {"id": requestid, "errno": "timeout", "ret": "fail"}
         except asyncio.CancelledError as e:
             helperbotlog.debug("wait_for_resp cancelled by asyncio")
         except Exception as e:
             helperbotlog.exception("{}".format(e))
+        finally:
+            self.pending_responses.pop(requestid, None)
 
     async def send_command(self, cmdjson, requestid):
+        # Can be awaited from any event loop, the command itself always runs on
+        # the helper bot loop that owns the MQTT client and pending responses
+        try:
+            if self.loop is None or self.loop is asyncio.get_event_loop():
+                return await self._send_command(cmdjson, requestid)
+
+            return await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(
+                    self._send_command(cmdjson, requestid), self.loop
+                )
+            )
+
+        except Exception as e:
+            helperbotlog.exception("{}".format(e))
+
+    def _command_key(self, cmdjson):
+        # Only status queries (get...) are safe to share between callers
+        if not cmdjson["cmdName"].lower().startswith("get"):
+            return None
+
+        payload = cmdjson["payload"]
+        if not isinstance(payload, str):
+            payload = json.dumps(payload, sort_keys=True)
+        return (cmdjson["toId"], cmdjson["cmdName"], payload)
+
+    async def _send_command(self, cmdjson, requestid):
+        key = self._command_key(cmdjson)
+        if key is None:
+            self.command_stats["sent"] += 1
+            return await self._publish_command(cmdjson, requestid)
+
+        loop = asyncio.get_event_loop()
+        cached = self.command_results.get(key)
+        if cached is not None and cached[0] > loop.time():
+            self.command_stats["cached"] += 1
+            return dict(cached[1], id=requestid)
+
+        task = self.inflight_commands.get(key)
+        if task is None:
+            self.command_stats["sent"] += 1
+            task = loop.create_task(self._publish_command(cmdjson, requestid))
+            task.add_done_callback(lambda task: self._command_done(key, task))
+            self.inflight_commands[key] = task
+        else:
+            self.command_stats["coalesced"] += 1
+
+        # Shielded, a caller giving up must not cancel the others' command
+        resp = await asyncio.shield(task)
+        return dict(resp, id=requestid) if resp else resp
+
+    def _command_done(self, key, task):
+        self.inflight_commands.pop(key, None)
+        if task.cancelled() or task.exception() is not None or not self.result_ttl:
+            return
+
+        resp = task.result()
+        if resp and resp.get("ret") == "ok":
+            now = asyncio.get_event_loop().time()
+            if len(self.command_results) >= 1000:
+                self.command_results = {
+                    k: v for k, v in self.command_results.items() if v[0] > now
+                }
+            self.command_results[key] = (now + self.result_ttl, resp)
+
+    async def _publish_command(self, cmdjson, requestid):
         try:
             ttopic = "iot/p2p/{}/helper1/bumper/helper1/{}/{}/{}/q/{}/{}".format(
                 cmdjson["cmdName"],
@@ -158,6 +240,9 @@ class MQTTHelperBot:
                 requestid,
                 cmdjson["payloadType"],
             )
+
+            # Register before publishing so a fast response can't be missed
+            self.pending_responses[requestid] = asyncio.get_event_loop().create_future()
             try:
                 await self.Client.publish(
                     ttopic, str(cmdjson["payload"]).encode(), QOS_0
@@ -304,7 +389,7 @@ class BumperMQTTServer_Plugin:
                     or str(didsplit[0]).startswith("helper")
                 ):
                     tmpbotdetail = str(didsplit[1]).split("/")
-                    bumper.bot_add(
+                    await bumper.bot_add_async(
                         username,
                         didsplit[0],
                         tmpbotdetail[0],
@@ -329,13 +414,13 @@ class BumperMQTTServer_Plugin:
                         authenticated = True
                     else:
                         auth = False
-                        if bumper.check_authcode(didsplit[0], password):
+                        if await bumper.check_authcode_async(didsplit[0], password):
                             auth = True
                         elif bumper.use_auth == False:
                             auth = True
 
                         if auth:
-                            bumper.client_add(userid, realm, resource)
+                            await bumper.client_add_async(userid, realm, resource)
                             mqttserverlog.debug(
                                 "client authenticated {}".format(userid)
                             )
@@ -354,14 +439,14 @@ class BumperMQTTServer_Plugin:
         try:
             didsplit = str(client_id).split("@")
 
-            bot = bumper.bot_get(didsplit[0])
+            bot = await bumper.bot_get_async(didsplit[0])
             if bot:
                 bumper.bot_set_mqtt(bot["did"], True)
                 return
 
             #clientuserid = didsplit[0]
             clientresource = didsplit[1].split("/")[1]
-            client = bumper.client_get(clientresource)
+            client = await bumper.client_get_async(clientresource)
             if client:
                 bumper.client_set_mqtt(client["resource"], True)
                 return
@@ -373,13 +458,13 @@ class BumperMQTTServer_Plugin:
         try:
             didsplit = str(client_id).split("@")
 
-            bot = bumper.bot_get(didsplit[0])
+            bot = await bumper.bot_get_async(didsplit[0])
             if bot:
                 bumper.bot_set_mqtt(bot["did"], False)
 
             #clientuserid = didsplit[0]
             clientresource = didsplit[1].split("/")[1]
-            client = bumper.client_get(clientresource)
+            client = await bumper.client_get_async(clientresource)
             if client:
                 bumper.client_set_mqtt(client["resource"], False)
 
@@ -0,0 +1,700 @@
+#!/usr/bin/env python3
+
+import abc
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from tinydb import TinyDB
+from tinydb.storages import JSONStorage
+from tinydb.middlewares import CachingMiddleware
+
+bumperlog = logging.getLogger("bumper")
+
+
+def expiration_timestamp(expiration):
+    # Token expirations are epoch seconds, older databases stored datetime strings
+    if isinstance(expiration, str):
+        return datetime.fromisoformat(expiration).timestamp()
+    return expiration
+
+
+class BumperStorage(abc.ABC):
+    # Storage backends hold the users, bots, clients and tokens tables.
+    # Records are plain dicts using the same field names for every backend.
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def user_get(self, userid):
+        pass
+
+    @abc.abstractmethod
+    def user_by_deviceid(self, devid):
+        pass
+
+    @abc.abstractmethod
+    def user_upsert(self, user):
+        pass
+
+    @abc.abstractmethod
+    def user_update(self, userid, fields):
+        pass
+
+    @abc.abstractmethod
+    def bot_get(self, did):
+        pass
+
+    @abc.abstractmethod
+    def bot_get_all(self):
+        pass
+
+    @abc.abstractmethod
+    def bot_list(self, dids=None, offset=0, limit=None):
+        # Bots ordered by did, only those in dids if given, from offset and at
+        # most limit of them. Returns (total, bots), total counting all matches
+        pass
+
+    @abc.abstractmethod
+    def bot_upsert(self, bot):
+        pass
+
+    @abc.abstractmethod
+    def bot_update(self, did, fields):
+        pass
+
+    @abc.abstractmethod
+    def bot_remove(self, did):
+        pass
+
+    @abc.abstractmethod
+    def client_get(self, resource):
+        pass
+
+    @abc.abstractmethod
+    def client_get_all(self):
+        pass
+
+    @abc.abstractmethod
+    def client_upsert(self, client):
+        pass
+
+    @abc.abstractmethod
+    def client_update(self, resource, fields):
+        pass
+
+    @abc.abstractmethod
+    def token_get(self, userid, token):
+        pass
+
+    @abc.abstractmethod
+    def token_get_by_userid(self, userid):
+        pass
+
+    @abc.abstractmethod
+    def token_get_by_token(self, token):
+        pass
+
+    @abc.abstractmethod
+    def token_get_by_authcode(self, authcode):
+        pass
+
+    @abc.abstractmethod
+    def token_get_all(self):
+        pass
+
+    @abc.abstractmethod
+    def token_insert(self, token):
+        pass
+
+    @abc.abstractmethod
+    def token_update(self, userid, token, fields):
+        pass
+
+    @abc.abstractmethod
+    def token_remove(self, tokens):
+        # tokens is a list of (userid, token) pairs, removed in one write
+        pass
+
+    @abc.abstractmethod
+    def token_remove_expired(self, now, userid=None):
+        # Removes tokens expired at now (for userid, or all users) in one write,
+        # returns the removed (userid, token) pairs
+        pass
+
+
+class TinyDBIndex:
+    # Hash index over a TinyDB table, keeping a copy of every record so lookups
+    # never scan or re-read the table. All writes to the table go through here.
+
+    def __init__(self, table, key, secondary=None):
+        self.table = table
+        self.key = key
+        self.secondary = secondary or {}
+        self.records = {}
+        self.doc_ids = {}
+        self.lookups = {name: {} for name in self.secondary}
+
+        for doc in table.all():
+            self._add(doc.doc_id, dict(doc))
+
+    def _add(self, doc_id, record):
+        try:
+            key = self.key(record)
+        except KeyError:
+            return  # Partial record without a key, can never be looked up
+
+        if key in self.records:
+            return  # Duplicate, the first record wins as with Query().get()
+
+        self.records[key] = record
+        self.doc_ids[key] = doc_id
+        for name, values in self.secondary.items():
+            for value in values(record):
+                self.lookups[name].setdefault(value, set()).add(key)
+
+    def _discard(self, key):
+        record = self.records.pop(key)
+        for name, values in self.secondary.items():
+            for value in values(record):
+                keys = self.lookups[name].get(value)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self.lookups[name][value]
+        return self.doc_ids.pop(key)
+
+    def get(self, key):
+        record = self.records.get(key)
+        return dict(record) if record is not None else None
+
+    def find(self, name, value):
+        return [dict(self.records[key]) for key in self.lookups[name].get(value, ())]
+
+    def all(self):
+        return [dict(record) for record in self.records.values()]
+
+    def upsert(self, record):
+        key = self.key(record)
+        if key in self.records:
+            self.update(key, record)
+        else:
+            self._add(self.table.insert(record), dict(record))
+
+    def update(self, key, fields):
+        if key not in self.records:
+            return
+
+        doc_id = self.doc_ids[key]
+        self.table.update(fields, doc_ids=[doc_id])
+        record = self.records[key]
+        self._discard(key)
+        record.update(fields)
+        self._add(doc_id, record)
+
+    def remove(self, keys):
+        doc_ids = [self._discard(key) for key in keys if key in self.records]
+        if doc_ids:
+            self.table.remove(doc_ids=doc_ids)
+
+
+class TinyDBStorage(BumperStorage):
+    def __init__(self, path, write_cache_size=1):
+        self.path = path
+        self.lock = threading.RLock()
+
+        # Reads are served from memory, writes are flushed every write_cache_size
+        storage = CachingMiddleware(JSONStorage)
+        storage.WRITE_CACHE_SIZE = write_cache_size
+
+        # Will create the database if it doesn't exist
+        self.db = TinyDB(path, storage=storage)
+
+        # Will create the tables if they don't exist, and index them
+        self.users = TinyDBIndex(
+            self.db.table("users", cache_size=0),
+            key=lambda user: user["userid"],
+            secondary={"devices": lambda user: user.get("devices", [])},
+        )
+        self.clients = TinyDBIndex(
+            self.db.table("clients", cache_size=0),
+            key=lambda client: client["resource"],
+        )
+        self.bots = TinyDBIndex(
+            self.db.table("bots", cache_size=0), key=lambda bot: bot["did"]
+        )
+        self.tokens = TinyDBIndex(
+            self.db.table("tokens", cache_size=0),
+            key=lambda token: (token["userid"], token["token"]),
+            secondary={
+                "userid": lambda token: [token["userid"]],
+                "token": lambda token: [token["token"]],
+                "authcode": lambda token: [token["authcode"]]
+                if token.get("authcode")
+                else [],
+            },
+        )
+
+        # Min-heap of (expiration, key), entries for removed or changed tokens are
+        # skipped when popped
+        self.token_expirations = []
+        for token in self.tokens.records.values():
+            self._push_expiration(token)
+        heapq.heapify(self.token_expirations)
+
+    def _push_expiration(self, token):
+        expiration = token.get("expiration")
+        if expiration is not None:
+            heapq.heappush(
+                self.token_expirations,
+                (expiration_timestamp(expiration), (token["userid"], token["token"])),
+            )
+
+    def flush(self):
+        with self.lock:
+            self.db.storage.flush()
+
+    def close(self):
+        with self.lock:
+            self.db.close()  # Flushes pending writes
+
+    def user_get(self, userid):
+        with self.lock:
+            return self.users.get(userid)
+
+    def user_by_deviceid(self, devid):
+        with self.lock:
+            users = self.users.find("devices", devid)
+            return users[0] if users else None
+
+    def user_upsert(self, user):
+        with self.lock:
+            self.users.upsert(user)
+
+    def user_update(self, userid, fields):
+        with self.lock:
+            self.users.update(userid, fields)
+
+    def bot_get(self, did):
+        with self.lock:
+            return self.bots.get(did)
+
+    def bot_get_all(self):
+        with self.lock:
+            return self.bots.all()
+
+    def bot_list(self, dids=None, offset=0, limit=None):
+        with self.lock:
+            if dids is None:
+                keys = sorted(self.bots.records)
+            else:
+                keys = sorted(did for did in set(dids) if did in self.bots.records)
+            end = None if limit is None else offset + limit
+            return len(keys), [self.bots.get(did) for did in keys[offset:end]]
+
+    def bot_upsert(self, bot):
+        with self.lock:
+            self.bots.upsert(bot)
+
+    def bot_update(self, did, fields):
+        with self.lock:
+            self.bots.update(did, fields)
+
+    def bot_remove(self, did):
+        with self.lock:
+            self.bots.remove([did])
+
+    def client_get(self, resource):
+        with self.lock:
+            return self.clients.get(resource)
+
+    def client_get_all(self):
+        with self.lock:
+            return self.clients.all()
+
+    def client_upsert(self, client):
+        with self.lock:
+            self.clients.upsert(client)
+
+    def client_update(self, resource, fields):
+        with self.lock:
+            self.clients.update(resource, fields)
+
+    def token_get(self, userid, token):
+        with self.lock:
+            return self.tokens.get((userid, token))
+
+    def token_get_by_userid(self, userid):
+        with self.lock:
+            return self.tokens.find("userid", userid)
+
+    def token_get_by_token(self, token):
+        with self.lock:
+            return self.tokens.find("token", token)
+
+    def token_get_by_authcode(self, authcode):
+        with self.lock:
+            return self.tokens.find("authcode", authcode)
+
+    def token_get_all(self):
+        with self.lock:
+            return self.tokens.all()
+
+    def token_insert(self, token):
+        with self.lock:
+            self.tokens.upsert(token)
+            self._push_expiration(token)
+
+    def token_update(self, userid, token, fields):
+        with self.lock:
+            self.tokens.update((userid, token), fields)
+            if "expiration" in fields:
+                self._push_expiration(self.tokens.records[(userid, token)])
+
+    def token_remove(self, tokens):
+        with self.lock:
+            self.tokens.remove(tokens)
+
+    def token_remove_expired(self, now, userid=None):
+        with self.lock:
+            expired = []
+            if userid is not None:
+                for token in self.tokens.find("userid", userid):
+                    expiration = token.get("expiration")
+                    if (
+                        expiration is not None
+                        and expiration_timestamp(expiration) <= now
+                    ):
+                        expired.append((token["userid"], token["token"]))
+            else:
+                # A token pushed again with the same expiration has two entries
+                collected = set()
+                while self.token_expirations and self.token_expirations[0][0] <= now:
+                    expiration, key = heapq.heappop(self.token_expirations)
+                    token = self.tokens.records.get(key)
+                    if (
+                        token is not None
+                        and key not in collected
+                        and expiration_timestamp(token.get("expiration")) == expiration
+                    ):
+                        collected.add(key)
+                        expired.append(key)
+
+            self.tokens.remove(expired)
+            return expired
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    userid TEXT PRIMARY KEY,
+    devices TEXT NOT NULL DEFAULT '[]',
+    bots TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS user_devices (
+    devid TEXT PRIMARY KEY,
+    userid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_devices_userid ON user_devices (userid);
+CREATE TABLE IF NOT EXISTS bots (
+    did TEXT PRIMARY KEY,
+    class TEXT,
+    company TEXT,
+    name TEXT,
+    nick TEXT,
+    resource TEXT
+);
+CREATE INDEX IF NOT EXISTS bots_resource ON bots (resource);
+CREATE TABLE IF NOT EXISTS clients (
+    resource TEXT PRIMARY KEY,
+    userid TEXT,
+    realm TEXT
+);
+CREATE INDEX IF NOT EXISTS clients_userid ON clients (userid);
+CREATE TABLE IF NOT EXISTS tokens (
+    userid TEXT NOT NULL,
+    token TEXT NOT NULL,
+    expiration REAL,
+    authcode TEXT,
+    PRIMARY KEY (userid, token)
+);
+CREATE INDEX IF NOT EXISTS tokens_token ON tokens (token);
+CREATE INDEX IF NOT EXISTS tokens_expiration ON tokens (expiration);
+CREATE INDEX IF NOT EXISTS tokens_authcode ON tokens (authcode);
+"""
+
+SQLITE_COLUMNS = {
+    "users": ("userid", "devices", "bots"),
+    "bots": ("did", "class", "company", "name", "nick", "resource"),
+    "clients": ("resource", "userid", "realm"),
+    "tokens": ("userid", "token", "expiration", "authcode"),
+}
+
+SQLITE_JSON_COLUMNS = ("devices", "bots")
+
+SQLITE_MAX_VARIABLES = 500  # Bound parameters per statement, older builds allow 999
+
+
+class SQLiteStorage(BumperStorage):
+    def __init__(self, path, migrate_from=None):
+        self.path = path
+        self.lock = threading.RLock()
+
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        has_devices = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'user_devices'"
+        ).fetchone()
+        self.conn.executescript(SQLITE_SCHEMA)
+        if not has_devices:
+            # Databases from before the device lookup table
+            with self.transaction():
+                for user in self._search("users"):
+                    self._set_devices(user["userid"], user["devices"])
+
+        if is_new and migrate_from and os.path.exists(migrate_from):
+            self.migrate_tinydb(migrate_from)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            # Take the write lock up front, a deferred transaction upgrading
+            # to a writer fails at once if another process is writing
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def migrate_tinydb(self, path):
+        # One-shot import of an existing TinyDB database
+        bumperlog.info("Migrating TinyDB database {} to {}".format(path, self.path))
+        old = TinyDBStorage(path)
+        try:
+            with self.transaction():
+                for user in old.users.all():
+                    self._insert("users", user)
+                    self._set_devices(user["userid"], user.get("devices", []))
+                for bot in old.bots.all():
+                    self._insert("bots", bot)
+                for client in old.clients.all():
+                    self._insert("clients", client)
+                for token in old.tokens.all():
+                    token["expiration"] = expiration_timestamp(token.get("expiration"))
+                    self._insert("tokens", token)
+        finally:
+            old.close()
+
+    def _to_row(self, record):
+        row = {}
+        for key, value in record.items():
+            if key in SQLITE_JSON_COLUMNS:
+                value = json.dumps(value)
+            row[key] = value
+        return row
+
+    def _from_row(self, row):
+        if row is None:
+            return None
+        record = dict(row)
+        for key in SQLITE_JSON_COLUMNS:
+            if key in record:
+                record[key] = json.loads(record[key])
+        if record.get("authcode") is None and "authcode" in record:
+            # Match TinyDB, where authcode is only set once issued
+            del record["authcode"]
+        return record
+
+    def _insert(self, table, record):
+        row = self._to_row(
+            {k: v for k, v in record.items() if k in SQLITE_COLUMNS[table]}
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                table, ", ".join(row), ", ".join("?" * len(row))
+            ),
+            list(row.values()),
+        )
+
+    def _update(self, table, where, fields):
+        row = self._to_row(fields)
+        if not row:
+            return
+        self.conn.execute(
+            "UPDATE {} SET {} WHERE {}".format(
+                table,
+                ", ".join("{} = ?".format(k) for k in row),
+                " AND ".join("{} = ?".format(k) for k in where),
+            ),
+            list(row.values()) + list(where.values()),
+        )
+
+    def _get(self, table, where):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM {} WHERE {}".format(
+                    table, " AND ".join("{} = ?".format(k) for k in where)
+                ),
+                list(where.values()),
+            ).fetchone()
+        return self._from_row(row)
+
+    def _search(self, table, where=None):
+        sql = "SELECT * FROM {}".format(table)
+        args = []
+        if where:
+            sql += " WHERE {}".format(" AND ".join("{} = ?".format(k) for k in where))
+            args = list(where.values())
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def user_get(self, userid):
+        return self._get("users", {"userid": userid})
+
+    def _set_devices(self, userid, devices):
+        # Keeps the devid -> userid lookup table in step with users.devices
+        self.conn.execute("DELETE FROM user_devices WHERE userid = ?", (userid,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO user_devices (devid, userid) VALUES (?, ?)",
+            [(devid, userid) for devid in devices],
+        )
+
+    def user_by_deviceid(self, devid):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT users.* FROM user_devices JOIN users USING (userid)"
+                " WHERE user_devices.devid = ?",
+                (devid,),
+            ).fetchone()
+        return self._from_row(row)
+
+    def user_upsert(self, user):
+        with self.transaction():
+            self._insert("users", user)
+            self._set_devices(user["userid"], user.get("devices", []))
+
+    def user_update(self, userid, fields):
+        with self.transaction():
+            self._update("users", {"userid": userid}, fields)
+            if "devices" in fields:
+                self._set_devices(userid, fields["devices"])
+
+    def bot_get(self, did):
+        return self._get("bots", {"did": did})
+
+    def bot_get_all(self):
+        return self._search("bots")
+
+    def bot_list(self, dids=None, offset=0, limit=None):
+        with self.lock:
+            if dids is None:
+                total = self.conn.execute("SELECT COUNT(*) FROM bots").fetchone()[0]
+                rows = self.conn.execute(
+                    "SELECT * FROM bots ORDER BY did LIMIT ? OFFSET ?",
+                    (-1 if limit is None else limit, offset),
+                ).fetchall()
+                return total, [self._from_row(row) for row in rows]
+
+            # A user's bots are few, fetch them all and page here
+            dids = sorted(set(dids))
+            rows = []
+            for i in range(0, len(dids), SQLITE_MAX_VARIABLES):
+                chunk = dids[i : i + SQLITE_MAX_VARIABLES]
+                rows += self.conn.execute(
+                    "SELECT * FROM bots WHERE did IN ({})".format(
+                        ", ".join("?" * len(chunk))
+                    ),
+                    chunk,
+                ).fetchall()
+
+        bots = sorted((self._from_row(row) for row in rows), key=lambda bot: bot["did"])
+        end = None if limit is None else offset + limit
+        return len(bots), bots[offset:end]
+
+    def bot_upsert(self, bot):
+        with self.lock:
+            self._insert("bots", bot)
+
+    def bot_update(self, did, fields):
+        with self.lock:
+            self._update("bots", {"did": did}, fields)
+
+    def bot_remove(self, did):
+        with self.lock:
+            self.conn.execute("DELETE FROM bots WHERE did = ?", (did,))
+
+    def client_get(self, resource):
+        return self._get("clients", {"resource": resource})
+
+    def client_get_all(self):
+        return self._search("clients")
+
+    def client_upsert(self, client):
+        with self.lock:
+            self._insert("clients", client)
+
+    def client_update(self, resource, fields):
+        with self.lock:
+            self._update("clients", {"resource": resource}, fields)
+
+    def token_get(self, userid, token):
+        return self._get("tokens", {"userid": userid, "token": token})
+
+    def token_get_by_userid(self, userid):
+        return self._search("tokens", {"userid": userid})
+
+    def token_get_by_token(self, token):
+        return self._search("tokens", {"token": token})
+
+    def token_get_by_authcode(self, authcode):
+        return self._search("tokens", {"authcode": authcode})
+
+    def token_get_all(self):
+        return self._search("tokens")
+
+    def token_insert(self, token):
+        with self.lock:
+            token = dict(token)
+            token["expiration"] = expiration_timestamp(token.get("expiration"))
+            self._insert("tokens", token)
+
+    def token_update(self, userid, token, fields):
+        with self.lock:
+            self._update("tokens", {"userid": userid, "token": token}, fields)
+
+    def token_remove(self, tokens):
+        with self.transaction():
+            self.conn.executemany(
+                "DELETE FROM tokens WHERE userid = ? AND token = ?", list(tokens)
+            )
+
+    def token_remove_expired(self, now, userid=None):
+        where = "expiration <= ?"
+        args = [now]
+        if userid is not None:
+            where += " AND userid = ?"
+            args.append(userid)
+
+        with self.transaction():
+            expired = self.conn.execute(
+                "SELECT userid, token FROM tokens WHERE {}".format(where), args
+            ).fetchall()
+            self.conn.execute("DELETE FROM tokens WHERE {}".format(where), args)
+        return [(row["userid"], row["token"]) for row in expired]
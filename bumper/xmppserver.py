@@ -2,6 +2,11 @@
 
 from threading import Thread
 import sys, socket, threading, re, time, logging, uuid, xml.etree.ElementTree as ET
+import errno
+import struct
+import asyncio
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
 import base64
 import ssl
 import contextvars
@@ -9,74 +14,192 @@ import bumper
 
 xmppserverlog = logging.getLogger("xmppserver")
 
+# The client whose received stanzas are being handled, set per connection task
+sending_client = contextvars.ContextVar("sending_client", default=None)
+
+
+class ClientRegistry(object):
+    # Connected clients by connection id and IP, and once authenticated by
+    # uid, resource, full JID and bare JID, so routing, eviction and removal
+    # are lookups. Keys are lowercase, lookups return snapshot lists so
+    # callers can remove clients while iterating.
+
+    indexes = ("ip", "uid", "resource", "bare")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.full = {}
+        self.index = {name: {} for name in self.indexes}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.ids.values()))
+
+    def __contains__(self, client):
+        with self.lock:
+            return self.ids.get(client.id) is client
+
+    def add(self, client):
+        with self.lock:
+            self.ids[client.id] = client
+            self._add_keys(client)
+
+    def update(self, client):
+        # Reindex after the client authenticated or bound a new JID
+        with self.lock:
+            if self.ids.get(client.id) is client:
+                self._remove_keys(client)
+                self._add_keys(client)
+
+    def remove(self, client):
+        with self.lock:
+            if self.ids.get(client.id) is not client:
+                return False
+            del self.ids[client.id]
+            self._remove_keys(client)
+            return True
+
+    def _add_keys(self, client):
+        jid = client.bumper_jid.lower()
+        client.registry_keys = {
+            "ip": client.address,
+            "uid": client.uid.lower(),
+            "resource": str(client.clientresource).lower(),
+            "bare": jid.split("/")[0],
+            "full": jid,
+        }
+        if jid:
+            self.full[jid] = client
+        for name in self.indexes:
+            key = client.registry_keys[name]
+            if key:
+                self.index[name].setdefault(key, set()).add(client)
+
+    def _remove_keys(self, client):
+        keys = client.registry_keys
+        if self.full.get(keys["full"]) is client:
+            del self.full[keys["full"]]
+        for name in self.indexes:
+            clients = self.index[name].get(keys[name])
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del self.index[name][keys[name]]
+
+    def get(self, client_id):
+        with self.lock:
+            return self.ids.get(client_id)
+
+    def by_jid(self, jid):
+        # A full JID finds one client, a bare JID all of that user's clients
+        jid = jid.lower()
+        with self.lock:
+            if "/" in jid:
+                client = self.full.get(jid)
+                return [client] if client else []
+            return list(self.index["bare"].get(jid, ()))
+
+    def by_ip(self, ip):
+        with self.lock:
+            return list(self.index["ip"].get(ip, ()))
+
+    def by_uid(self, uid):
+        with self.lock:
+            return list(self.index["uid"].get(str(uid).lower(), ()))
+
+    def by_resource(self, resource):
+        with self.lock:
+            return list(self.index["resource"].get(str(resource).lower(), ()))
+
+
+class ConnectionRateLimiter(object):
+    # Token bucket per IP, allowing a burst of `connections` and then
+    # `connections` per `seconds`. Buckets that have refilled are pruned.
+
+    def __init__(self, connections, seconds):
+        self.burst = connections
+        self.rate = connections / seconds
+        self.buckets = {}
+        self.prune_at = 10000
+
+    def allow(self, ip, now):
+        tokens, last = self.buckets.get(ip, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[ip] = (tokens - 1 if allowed else tokens, now)
+
+        if len(self.buckets) > self.prune_at:
+            self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        full = [
+            ip
+            for ip, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate >= self.burst
+        ]
+        for ip in full:
+            del self.buckets[ip]
+        self.prune_at = max(10000, len(self.buckets) * 2)
+
 
 class XMPPServer:
     server_id = "ecouser.net"
     client_id = None
-    clients = []
+    clients = ClientRegistry()
     exit_flag = False
 
-    def __init__(self, address):
-        # Initialize bot server
+    def __init__(self, address, usessl=False):
+        # Initialize bot server, plain XMPP unless usessl
         self.address = address
+        self.usessl = usessl
+        self.loop = None
+        self.socket = None
+        self.ssl_ctx = None
+        self.rate_limiter = None
+        self.accept_stats = {
+            "wakeups": 0,
+            "accepted": 0,
+            "rate_limited": 0,
+            "max_batch": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "connected": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
 
     def run(self, run_async=False):
         if run_async:
+            xloop = asyncio.new_event_loop()
             xmppserverlog.debug("Starting XMPPServer Thread: 1")
-            self.xmppthread = Thread(name="XMPPServer_Thread", target=self.run_server)
+            self.xmppthread = Thread(
+                name="XMPPServer_Thread", target=self.run_server, args=(xloop,)
+            )
             self.xmppthread.setDaemon(True)
             self.xmppthread.start()
 
         else:
             try:
-                self.run_server()
+                self.run_server(asyncio.get_event_loop())
             except KeyboardInterrupt:
                 self.disconnect()
 
-    def run_server(self):
+    def run_server(self, loop):
         logging.info("Starting XMPP Server at {}".format(self.address))
         print("Starting XMPP Server at {}".format(self.address))
 
         # xmppserverlog.setLevel(logging.DEBUG)
 
-        # Set SSL Context
-        self.ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self.ssl_ctx.load_cert_chain(
-            certfile=bumper.server_cert, keyfile=bumper.server_key
-        )
-
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
         try:
-            self.socket.bind(self.address)
-            self.socket.listen(5)
-
-            xmppserverlog.debug(
-                "listening on {}:{}".format(self.address[0], self.address[1])
-            )
-            while not self.exit_flag:
-                connection, client_address = self.socket.accept()
-
-                # disconnect any clients with this ip
-                for client in self.clients:
-                    if client.address == client_address[0]:
-                        xmppserverlog.debug(
-                            "disconnecting existing client {} with resource {}".format(
-                                client.address, client.clientresource
-                            )
-                        )
-                        client._disconnect()
-                        self.remove_client_byip(client.address)
-
-                xmppserverlog.debug(
-                    "starting new client with ip {}".format(client_address[0])
-                )
-                thread_id = uuid.uuid4()
-                client = Client(thread_id, connection, client_address)
-                client.setDaemon(True)
-                client.start()
-                self.clients.append(client)
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start_server())
+            loop.run_forever()
 
         except PermissionError as e:
             if "bind" in e.strerror:
@@ -95,60 +218,306 @@ class XMPPServer:
             xmppserverlog.exception("{}".format(e))
 
         finally:
-            connection.shutdown(socket.SHUT_RDWR)
-            connection.close()
             self.disconnect()
             xmppserverlog.info("disconnecting")
 
-        self.socket.close()
+    async def start_server(self):
+        # All connections are served from this one event loop
+        self.loop = asyncio.get_event_loop()
+
+        self.ssl_ctx = None
+        if self.usessl:
+            # Set SSL Context
+            self.ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_ctx.load_cert_chain(
+                certfile=bumper.server_cert, keyfile=bumper.server_key
+            )
+
+        if bumper.xmpp_ip_rate_limit:
+            self.rate_limiter = ConnectionRateLimiter(*bumper.xmpp_ip_rate_limit)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(bumper.xmpp_listen_backlog)
+        self.socket.setblocking(False)
+        self.loop.add_reader(self.socket.fileno(), self._accept_connections)
+
+        xmppserverlog.debug(
+            "listening on {}:{}".format(self.address[0], self.address[1])
+        )
+
+    def close(self):
+        # Stop accepting connections, must be called from the server loop
+        if self.socket is not None:
+            self.loop.remove_reader(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+
+    def _accept_connections(self):
+        # Accept every pending connection on each wakeup, so a storm of
+        # reconnecting bots doesn't overflow the listen backlog
+        wakeup = time.monotonic()
+        self.accept_stats["wakeups"] += 1
+        self._sample_accept_queue()
+
+        batch = 0
+        while self.socket is not None:
+            try:
+                connection, client_address = self.socket.accept()
+
+            except (BlockingIOError, InterruptedError):
+                break
+
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # Out of descriptors or memory, back off instead of spinning
+                    xmppserverlog.error("accept failed, retrying in 1s - {}".format(e))
+                    self.loop.remove_reader(self.socket.fileno())
+                    self.loop.call_later(1, self._resume_accepting)
+                else:
+                    xmppserverlog.exception("{}".format(e))
+                break
+
+            batch += 1
+            if self.rate_limiter and not self.rate_limiter.allow(
+                client_address[0], wakeup
+            ):
+                self.accept_stats["rate_limited"] += 1
+                xmppserverlog.debug(
+                    "rate limited connection from {}".format(client_address[0])
+                )
+                connection.close()
+                continue
+
+            connection.setblocking(False)
+            self.accept_stats["accepted"] += 1
+            self.loop.create_task(
+                self._start_connection(connection, client_address, wakeup)
+            )
+
+        self.accept_stats["max_batch"] = max(self.accept_stats["max_batch"], batch)
+
+    def _resume_accepting(self):
+        if self.socket is not None:
+            self.loop.add_reader(self.socket.fileno(), self._accept_connections)
+
+    def _sample_accept_queue(self):
+        # On Linux TCP_INFO of a listening socket reports the accept queue
+        # length in tcpi_unacked
+        if not hasattr(socket, "TCP_INFO"):
+            return
+        try:
+            info = self.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+            depth = struct.unpack_from("I", info, 24)[0]
+        except (OSError, struct.error):
+            return
+        self.accept_stats["queue_depth"] = depth
+        self.accept_stats["max_queue_depth"] = max(
+            self.accept_stats["max_queue_depth"], depth
+        )
+
+    async def _start_connection(self, connection, client_address, wakeup):
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        # Plain XMPP unless TLS was asked for
+        ssl_ctx = self.ssl_ctx if self.usessl else None
+        try:
+            transport, _ = await self.loop.connect_accepted_socket(
+                lambda: protocol, sock=connection, ssl=ssl_ctx
+            )
+
+        except Exception as e:
+            xmppserverlog.debug(
+                "connection from {} failed - {}".format(client_address[0], e)
+            )
+            connection.close()
+            return
+
+        # Time from the wakeup that accepted it until the stream is usable
+        latency = time.monotonic() - wakeup
+        self.accept_stats["connected"] += 1
+        self.accept_stats["latency_total"] += latency
+        self.accept_stats["latency_max"] = max(
+            self.accept_stats["latency_max"], latency
+        )
+
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        await self.handle_connection(reader, writer)
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+
+        # disconnect any clients with this ip
+        self.remove_client_byip(client_address[0])
+
+        xmppserverlog.debug("starting new client with ip {}".format(client_address[0]))
+        client_id = uuid.uuid4()
+        client = Client(client_id, reader, writer, client_address)
+        self.clients.add(client)
+        try:
+            await client.run()
+        finally:
+            self.clients.remove(client)
 
     def disconnect(self):
         try:
-            xmppserverlog.debug("waiting for all client threads to exit")
+            xmppserverlog.debug("closing all client connections")
             for client in self.clients:
                 client._disconnect()
 
+            if self.socket is not None:
+                if self.loop.is_running():
+                    self.loop.call_soon_threadsafe(self.close)
+                else:
+                    self.close()
+
             self.exit_flag = True
             xmppserverlog.debug("shutting down")
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def remove_client_byip(self, ip):
-        for client in self.clients:
-            if client.address == ip:
-                xmppserverlog.debug(
-                    "removing client from client list with ip {} and resource {}".format(
-                        client.address, client.clientresource
-                    )
+    def _remove_clients(self, clients):
+        for client in clients:
+            xmppserverlog.debug(
+                "removing client from client list with ip {} and resource {}".format(
+                    client.address, client.clientresource
                 )
-                client._disconnect()
-                self.clients.remove(client)
+            )
+            client._disconnect()
+            self.clients.remove(client)
+
+    def remove_client_byip(self, ip):
+        self._remove_clients(self.clients.by_ip(ip))
 
     def remove_client_byresource(self, resource):
-        for client in self.clients:
-            if str(client.clientresource).lower() == str(resource).lower():
-                xmppserverlog.debug(
-                    "removing client from client list with ip {} and resource {}".format(
-                        client.address, client.clientresource
-                    )
-                )
-                client._disconnect()
-                self.clients.remove(client)
+        self._remove_clients(self.clients.by_resource(resource))
 
     def remove_client_byuid(self, uid):
-        for client in self.clients:
-            if str(client.uid).lower() == str(uid).lower():
-                xmppserverlog.debug(
-                    "removing client from client list with ip {} and resource {}".format(
-                        client.address, client.clientresource
-                    )
-                )
-                client._disconnect()
-                self.clients.remove(client)
-
-
-class Client(threading.Thread):
+        self._remove_clients(self.clients.by_uid(uid))
+
+
+STANZA_START_TAG = re.compile(
+    r"""(<[^\s/>]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>)"""
+)
+STANZA_FROM_ATTR = re.compile(r"""\sfrom\s*=\s*(?:"[^"]*"|'[^']*')""")
+
+
+def stanza_set_from(stanza, jid):
+    # Sets the from attribute on a raw stanza, leaving the rest of it as sent
+    tag = STANZA_START_TAG.match(stanza)
+    attrs = STANZA_FROM_ATTR.sub("", tag.group(2))
+    return "{} from={}{}{}".format(
+        tag.group(1), quoteattr(jid), attrs, stanza[tag.end() :]
+    )
+
+
+class StreamParser:
+    # Incremental parser for one XMPP stream. Bytes are fed as they arrive and
+    # each complete top-level stanza is returned once, with its raw bytes.
+    STREAM_TAG = "{http://etherx.jabber.org/streams}stream"
+
+    def __init__(self):
+        self.events = []
+        self._reset()
+
+    def _reset(self):
+        self.parser = expat.ParserCreate(namespace_separator=" ")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+        self.buffer = bytearray()  # Unconsumed input, starting at self.offset
+        self.offset = 0
+        self.depth = 0
+        self.empty = False
+        self.stream_depth = None
+        self.builder = None
+
+    def feed(self, data):
+        self._parse(data)
+        events, self.events = self.events, []
+        return events
+
+    def _parse(self, data):
+        self.buffer += data
+        try:
+            self.parser.Parse(data)
+
+        except expat.ExpatError as e:
+            # Restart with what is left, like an <?xml ?> sent with a new
+            # stream header, or drop it if a fresh parser can't use it either
+            index = self.parser.ErrorByteIndex
+            remaining = bytes(self.buffer[index - self.offset :])
+            self._reset()
+            if index > 0:
+                self._parse(remaining)
+            else:
+                xmppserverlog.error("xml parse error - {} - {}".format(remaining, e))
+
+    def _consume(self, index):
+        # Drop input before index, it is not needed to slice later stanzas
+        del self.buffer[: index - self.offset]
+        self.offset = index
+
+    def _fixname(self, name):
+        uri, _, local = name.rpartition(" ")
+        if uri == "" or uri == "jabber:client":
+            return local  # Stanzas are handled without the stream namespace
+        return "{{{}}}{}".format(uri, local)
+
+    def _start(self, name, attrs):
+        tag = self._fixname(name)
+        self.depth += 1
+        self.empty = True  # Until any content or end tag is seen
+        index = self.parser.CurrentByteIndex
+
+        if tag == self.STREAM_TAG:
+            self.stream_depth = self.depth
+            self._consume(index)
+            end = self.buffer.find(b">") + 1
+            self.events.append(("stream", None, bytes(self.buffer[:end])))
+            return
+
+        if self.builder is None and self.depth == (self.stream_depth or 0) + 1:
+            self.builder = ET.TreeBuilder()
+            self._consume(index)
+
+        if self.builder is not None:
+            attrib = {}
+            for key, value in attrs.items():
+                attrib[self._fixname(key)] = value
+            self.builder.start(tag, attrib)
+
+    def _end(self, name):
+        tag = self._fixname(name)
+        empty, self.empty = self.empty, False
+        if self.builder is not None:
+            self.builder.end(tag)
+            if self.depth == (self.stream_depth or 0) + 1:
+                # Empty elements end at the end of their tag, others at "</"
+                end = self.parser.CurrentByteIndex - self.offset
+                if not (empty and self.buffer[end - 2 : end] == b"/>"):
+                    end = self.buffer.find(b">", end) + 1
+                raw = bytes(self.buffer[:end])
+                self.events.append(("stanza", self.builder.close(), raw))
+                self.builder = None
+                self._consume(self.offset + end)
+
+        elif tag == self.STREAM_TAG and self.depth == self.stream_depth:
+            self.events.append(("close", None, None))
+            self.stream_depth = None
+
+        self.depth -= 1
+
+    def _data(self, data):
+        self.empty = False
+        if self.builder is not None:
+            self.builder.data(data)
+
+
+class Client:
     IDLE = 0
     CONNECT = 1
     INIT = 2
@@ -159,62 +528,148 @@ class Client(threading.Thread):
     BOT = 1
     CONTROLLER = 2
 
-    def __init__(self, thread_id, connection, client_address):
-        threading.Thread.__init__(self)
-        self.id = thread_id
+    def __init__(self, client_id, reader, writer, client_address):
+        self.id = client_id
         self.name = "XMPP_Client_{}".format(client_address[0])
         self.type = self.UNKNOWN
         self.state = self.IDLE
-        self.connection = connection
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_event_loop()
+        self.high_water = bumper.xmpp_send_high_water
+        self.low_water = bumper.xmpp_send_low_water
+        self.slow_consumer = bumper.xmpp_slow_consumer
+        self.writer.transport.set_write_buffer_limits(
+            high=self.high_water, low=self.low_water
+        )
+        self.outbox = []  # Sends coalesced into one write per loop iteration
+        self.outbox_size = 0
+        self.drain_task = None
+        self.congested = set()  # Slow consumers this client sent to (block)
+        self.send_stats = {"stanzas": 0, "writes": 0, "dropped": 0}
         self.address = client_address[0]
         self.clientresource = ""
         self.devclass = ""
         self.bumper_jid = ""
         self.uid = ""
+        self.registry_keys = None  # Keys in XMPPServer.clients
+        self.stream_parser = StreamParser()
         self.log_sent_message = False  # Set to true to log sends
         self.log_incoming_data = True  # Set to true to log sends
 
         xmppserverlog.debug(
-            "new client thread init for client with ip {}".format(self.address)
+            "new client init for client with ip {}".format(self.address)
         )
 
     def send(self, command):
         try:
-            if not self.connection._closed:
+            if not self.writer.is_closing():
                 if self.log_sent_message:
                     xmppserverlog.debug("send {} - {}".format(self.address, command))
-                self.connection.send(command.encode())
+                if isinstance(command, str):
+                    command = command.encode()
 
-        except BrokenPipeError as e:
-            xmppserverlog.debug("{}".format(e))
-            self._set_state("DISCONNECT")
+                buffered = self.writer.transport.get_write_buffer_size()
+                if buffered + self.outbox_size + len(command) > self.high_water:
+                    if not self._slow_consumer(len(command)):
+                        return
 
-        except ConnectionResetError as e:
-            xmppserverlog.debug("{}".format(e))
-            self._set_state("DISCONNECT")
-
-        except ConnectionAbortedError as e:
-            xmppserverlog.debug("{}".format(e))
-            self._set_state("DISCONNECT")
-
-        except OSError as e:
-            xmppserverlog.debug("{}".format(e))
+                if not self.outbox:
+                    self.loop.call_soon(self._flush)
+                self.outbox.append(command)
+                self.outbox_size += len(command)
+                self.send_stats["stanzas"] += 1
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _disconnect(self):
-        try:
+    def _slow_consumer(self, size):
+        # Returns True if the send should still be queued
+        if self.state == self.DISCONNECT:
+            return False  # Already on its way out
+
+        if self.slow_consumer == "drop":
+            self.send_stats["dropped"] += 1
+            xmppserverlog.debug(
+                "dropping {} bytes for slow consumer {}".format(size, self.address)
+            )
+            return False
+
+        if self.slow_consumer == "block":
+            # The client whose stanza this is stops reading until we drain
+            sender = sending_client.get()
+            if sender is not None and sender is not self:
+                sender.congested.add(self)
+            return True
+
+        xmppserverlog.info("disconnecting slow consumer {}".format(self.address))
+        self._set_state("DISCONNECT")
+        return False
+
+    def _flush(self):
+        if self.outbox:
+            data = b"".join(self.outbox)
+            self.outbox = []
+            self.outbox_size = 0
+            try:
+                if not self.writer.is_closing():
+                    self.writer.write(data)
+                    self.send_stats["writes"] += 1
+
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                xmppserverlog.debug("{}".format(e))
+                self._set_state("DISCONNECT")
+
+            except OSError as e:
+                xmppserverlog.debug("{}".format(e))
+
+            except Exception as e:
+                xmppserverlog.exception("{}".format(e))
+
+    def drained(self):
+        # One drain shared by all senders waiting for this client
+        self._flush()
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = self.loop.create_task(self.writer.drain())
+        return asyncio.shield(self.drain_task)
+
+    async def _wait_for_congested(self):
+        while self.congested:
+            client = self.congested.pop()
+            try:
+                await asyncio.wait_for(client.drained(), bumper.xmpp_block_timeout)
 
-            bot = bumper.bot_get(self.uid)
+            except asyncio.TimeoutError:
+                xmppserverlog.info(
+                    "disconnecting slow consumer {}".format(client.address)
+                )
+                client._set_state("DISCONNECT")
+
+            except Exception as e:
+                xmppserverlog.debug("{}".format(e))
+
+    async def _set_xmpp(self, xmpp):
+        try:
+            bot = await bumper.bot_get_async(self.uid)
             if bot:
-                bumper.bot_set_xmpp(bot["did"], False)
+                bumper.bot_set_xmpp(bot["did"], xmpp)
 
-            client = bumper.client_get(self.clientresource)
+            client = await bumper.client_get_async(self.clientresource)
             if client:
-                bumper.client_set_xmpp(client["resource"], False)
+                bumper.client_set_xmpp(client["resource"], xmpp)
+
+        except Exception as e:
+            xmppserverlog.exception("{}".format(e))
+
+    def _disconnect(self):
+        try:
+            XMPPServer.clients.remove(self)
 
-            self.connection.close()
+            # May be called from the sweep in the main thread, clear presence
+            # and close on our loop
+            if not self.loop.is_closed():
+                asyncio.run_coroutine_threadsafe(self._set_xmpp(False), self.loop)
+                self.loop.call_soon_threadsafe(self.writer.close)
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
@@ -242,12 +697,24 @@ class Client(threading.Thread):
 
             self.state = new_state
 
+            if new_state == self.INIT:
+                # Authenticated, index by uid and resource
+                XMPPServer.clients.update(self)
+
             if new_state == 5:
                 self._disconnect()
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
+    def _ready(self, clients):
+        # Clients other than this one that can receive forwarded stanzas
+        return [
+            client
+            for client in clients
+            if client.bumper_jid != self.bumper_jid and client.state == client.READY
+        ]
+
     def _handle_ctl(self, xml, data):
         try:
 
@@ -282,27 +749,17 @@ class Client(threading.Thread):
                     XMPPServer.client_id = ctl.get("admin")
                     return
 
-            # forward
-            for client in XMPPServer.clients:
-                if (
-                    client.bumper_jid != self.bumper_jid
-                    and client.state == client.READY
-                ):
-                    ctl_to = xml.get("to")
-                    xml.attrib["from"] = "{}".format(self.bumper_jid)
-                    rxmlstring = ET.tostring(xml).decode("utf-8")
-                    # clean up string to remove namespaces added by ET
-                    rxmlstring = rxmlstring.replace("xmlns:ns0=", "xmlns=")
-                    rxmlstring = rxmlstring.replace("ns0:", "")
-                    rxmlstring = rxmlstring.replace('iq xmlns="com:ctl"', "iq")
-                    rxmlstring = rxmlstring.replace("<query", '<query xmlns="com:ctl"')
-
-                    if client.type == self.BOT:
-                        if client.uid.lower() in ctl_to.lower():
-                            xmppserverlog.info(
-                                "Sending ctl to bot: {}".format(rxmlstring)
-                            )
-                            client.send(rxmlstring)
+            # forward to the bot, addressed by its uid
+            ctl_to = xml.get("to")
+            uid = ctl_to.split("@")[0]
+            recipients = self._ready(XMPPServer.clients.by_uid(uid))
+            bots = [client for client in recipients if client.type == self.BOT]
+            if bots:
+                rxmlstring = stanza_set_from(data, self.bumper_jid)
+                rxmlbytes = rxmlstring.encode()
+                for client in bots:
+                    xmppserverlog.info("Sending ctl to bot: {}".format(rxmlstring))
+                    client.send(rxmlbytes)
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
@@ -321,27 +778,12 @@ class Client(threading.Thread):
                 pingto = xml.get("to")
                 pingfrom = self.bumper_jid
 
-                xml.attrib["from"] = pingfrom
-                pingstring = ET.tostring(xml).decode("utf-8")
-                # clean up string to remove namespaces added by ET
-                pingstring = pingstring.replace("xmlns:ns0=", "xmlns=")
-                pingstring = pingstring.replace("ns0:", "")
-                pingstring = pingstring.replace('iq xmlns="com:ctl"', "iq")
-                pingstring = pingstring.replace("<query", '<query xmlns="com:ctl"')
-
-                for client in XMPPServer.clients:
-                    if (
-                        client.bumper_jid != self.bumper_jid
-                        and client.state == client.READY
-                    ):
-                        if pingto.lower() in client.bumper_jid.lower():
-                            pingstring = '<iq type="result" id="{}" from="{}" to="{}" />'.format(
-                                xml.get("id"), pingfrom, pingto
-                            )
-                            xmppserverlog.debug(
-                                "ping from {} to {}".format(pingfrom, pingto)
-                            )
-                            client.send(pingstring)
+                for client in self._ready(XMPPServer.clients.by_jid(pingto)):
+                    pingstring = '<iq type="result" id="{}" from="{}" to="{}" />'.format(
+                        xml.get("id"), pingfrom, pingto
+                    )
+                    xmppserverlog.debug("ping from {} to {}".format(pingfrom, pingto))
+                    client.send(pingstring)
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
@@ -349,7 +791,6 @@ class Client(threading.Thread):
     def _handle_result(self, xml, data):
         try:
             ctl_to = xml.get("to")
-            xml.attrib["from"] = self.bumper_jid
             if (
                 "errno='103' error='permission denied," in data
             ):  # No permissions, usually if bot was last on Ecovac network
@@ -387,12 +828,8 @@ class Client(threading.Thread):
                         )
 
             else:
-                rxmlstring = ET.tostring(xml).decode("utf-8")
-                # clean up string to remove namespaces added by ET
-                rxmlstring = rxmlstring.replace("xmlns:ns0=", "xmlns=")
-                rxmlstring = rxmlstring.replace("ns0:", "")
-                rxmlstring = rxmlstring.replace('iq xmlns="com:ctl"', "iq")
-                rxmlstring = rxmlstring.replace("<query", '<query xmlns="com:ctl"')
+                rxmlstring = stanza_set_from(data, self.bumper_jid)
+                rxmlbytes = rxmlstring.encode()
                 if self.type == self.BOT:
                     if ctl_to == "de.ecorobot.net":  # Send to all clients
                         xmppserverlog.debug(
@@ -401,36 +838,32 @@ class Client(threading.Thread):
                             )
                         )
                         for client in XMPPServer.clients:
-                            client.send(rxmlstring)
+                            client.send(rxmlbytes)
 
                 if xml.get("to").find("@") == -1:  # No to address
                     ctl_to = xml.get("to")
                 else:
                     ctl_to = "{}@ecouser.net".format(ctl_to.split("@")[0])
 
-                for client in XMPPServer.clients:
-                    if (
-                        client.bumper_jid != self.bumper_jid
-                        and client.state == client.READY
-                    ):
-                        if not "@" in ctl_to:  # No user@, send to all clients?
-                            # TODO: Revisit later, this may be wrong
-                            client.send(rxmlstring)
-
-                        elif (
-                            client.uid.lower() in ctl_to.lower()
-                        ):  # If client matches TO=
-                            xmppserverlog.debug(
-                                "Sending from {} to client {}: {}".format(
-                                    self.uid, client.uid, rxmlstring
-                                )
+                if not "@" in ctl_to:  # No user@, send to all clients?
+                    # TODO: Revisit later, this may be wrong
+                    for client in self._ready(XMPPServer.clients):
+                        client.send(rxmlbytes)
+
+                else:  # Send to the clients of the user in TO=
+                    uid = ctl_to.split("@")[0]
+                    for client in self._ready(XMPPServer.clients.by_uid(uid)):
+                        xmppserverlog.debug(
+                            "Sending from {} to client {}: {}".format(
+                                self.uid, client.uid, rxmlstring
                             )
-                            client.send(rxmlstring)
+                        )
+                        client.send(rxmlbytes)
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _handle_connect(self, data, xml=None):
+    async def _handle_connect(self, data, xml=None):
         try:
 
             if self.state == self.CONNECT:
@@ -441,20 +874,16 @@ class Client(threading.Thread):
                         ec = data.decode("utf-8").find(".ecorobot.net")
                         if ec > -1:
                             self.devclass = data.decode("utf-8")[sc + 4 : ec]
-                        # ack jabbr:client
-                        # no STARTTLS
+                        # ack jabbr:client, together with authentication support
+                        # for iq-auth (fallback) and SASL, no STARTTLS
                         self.send(
                             '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="{}">'.format(
                                 XMPPServer.server_id
                             )
+                            + '<stream:features><auth xmlns="http://jabber.org/features/iq-auth"/><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
                         )
                         # with STARTTLS
                         # self.send('<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns:tls="http://www.ietf.org/rfc/rfc2595.txt" xmlns="jabber:client" version="1.0" id="1" from="{}">'.format(XMPPServer.server_id))
-                        time.sleep(0.25)
-                        # send authentication support for iq-auth (fallback) and SASL
-                        self.send(
-                            '<stream:features><auth xmlns="http://jabber.org/features/iq-auth"/><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-                        )
                         # self.send('<stream:features><auth xmlns="http://jabber.org/features/iq-auth"/></stream:features>')
 
                     else:
@@ -462,11 +891,11 @@ class Client(threading.Thread):
 
                 else:
                     if "jabber:iq:auth" in xml.tag:  # Handle iq-auth
-                        self._handle_iq_auth(xml)
+                        await self._handle_iq_auth(xml)
                     elif (
                         "urn:ietf:params:xml:ns:xmpp-sasl" in xml.tag
                     ):  # Handle SASL Auth
-                        self._handle_sasl_auth(xml)
+                        await self._handle_sasl_auth(xml)
                     else:
                         xmppserverlog.error("Couldn't handle: {}".format(xml))
 
@@ -474,16 +903,12 @@ class Client(threading.Thread):
                 if xml == None:
                     # Client getting session after authentication
                     if data.decode("utf-8").find("jabber:client") > -1:
-                        # ack jabbr:client
+                        # ack jabbr:client, together with the session features
                         self.send(
                             '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="{}">'.format(
                                 XMPPServer.server_id
                             )
-                        )
-                        time.sleep(0.25)
-                        # session
-                        self.send(
-                            '<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
+                            + '<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
                         )
 
                 else:  # Handle init bind
@@ -494,14 +919,14 @@ class Client(threading.Thread):
 
                     if xml.tag == "iq":
                         if child == "bind":
-                            self._handle_bind(xml)
+                            await self._handle_bind(xml)
                     else:
                         xmppserverlog.error("Couldn't handle: {}".format(xml))
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _handle_iq_auth(self, data):
+    async def _handle_iq_auth(self, data):
         try:
             xml = ET.fromstring(data.decode("utf-8"))
             ctl = xml[0][0]
@@ -543,7 +968,7 @@ class Client(threading.Thread):
                 if not self.uid.startswith("fuid"):
 
                     # Need sample data to see details here
-                    bumper.bot_add("", self.uid, "", resource, "eco-legacy")
+                    await bumper.bot_add_async("", self.uid, "", resource, "eco-legacy")
                     xmppserverlog.info("bot authenticated {}".format(self.uid))
 
                     # Client authenticated, move to next state
@@ -554,13 +979,15 @@ class Client(threading.Thread):
 
                 else:
                     auth = False
-                    if bumper.check_authcode(self.uid, authcode):
+                    if await bumper.check_authcode_async(self.uid, authcode):
                         auth = True
                     elif bumper.use_auth == False:
                         auth = True
 
                     if auth:
-                        bumper.client_add(self.uid, "bumper", self.clientresource)
+                        await bumper.client_add_async(
+                            self.uid, "bumper", self.clientresource
+                        )
                         xmppserverlog.debug("client authenticated {}".format(self.uid))
 
                         # Client authenticated, move to next state
@@ -594,7 +1021,7 @@ class Client(threading.Thread):
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _handle_sasl_auth(self, xml):
+    async def _handle_sasl_auth(self, xml):
         try:
 
             saslauth = base64.b64decode(xml.text).decode("utf-8").split("/")
@@ -613,7 +1040,9 @@ class Client(threading.Thread):
 
             if not self.uid.startswith("fuid"):
                 # Need sample data to see details here
-                bumper.bot_add(self.uid, self.uid, self.devclass, "atom", "eco-legacy")
+                await bumper.bot_add_async(
+                    self.uid, self.uid, self.devclass, "atom", "eco-legacy"
+                )
                 self.type = self.BOT
                 xmppserverlog.info("bot authenticated {}".format(self.uid))
                 # Send response
@@ -626,14 +1055,16 @@ class Client(threading.Thread):
 
             else:
                 auth = False
-                if bumper.check_authcode(self.uid, authcode):
+                if await bumper.check_authcode_async(self.uid, authcode):
                     auth = True
                 elif bumper.use_auth == False:
                     auth = True
 
                 if auth:
                     self.type = self.CONTROLLER
-                    bumper.client_add(self.uid, "bumper", self.clientresource)
+                    await bumper.client_add_async(
+                        self.uid, "bumper", self.clientresource
+                    )
                     xmppserverlog.debug("client authenticated {}".format(self.uid))
 
                     # Client authenticated, move to next state
@@ -653,16 +1084,9 @@ class Client(threading.Thread):
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _handle_bind(self, xml):
+    async def _handle_bind(self, xml):
         try:
-
-            bot = bumper.bot_get(self.uid)
-            if bot:
-                bumper.bot_set_xmpp(bot["did"], True)
-
-            client = bumper.client_get(self.clientresource)
-            if client:
-                bumper.client_set_xmpp(client["resource"], True)
+            await self._set_xmpp(True)
 
             clientbindxml = xml.getchildren()
             clientresourcexml = clientbindxml[0].getchildren()
@@ -697,6 +1121,7 @@ class Client(threading.Thread):
                     xml.get("id"), self.bumper_jid
                 )
 
+            XMPPServer.clients.update(self)
             self._set_state("BIND")
             self.send(res)
 
@@ -773,101 +1198,44 @@ class Client(threading.Thread):
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _parse_data(self, data):
+    async def _parse_data(self, data):
+        for event, item, raw in self.stream_parser.feed(data):
+            if event == "stream":
+                # Start stream and connect, sent again after authentication
+                if self.state == self.CONNECT or self.state == self.INIT:
+                    xmppserverlog.debug("Handling connect data - {}".format(raw))
+                    await self._handle_connect(raw)
 
-        if data.decode("utf-8").startswith(
-            "<?xml"
-        ):  # Strip <?xml and add artificial root
-            newdata = (
-                re.sub(r"(<\?xml[^>]+\?>)", r"<root>", data.decode("utf-8")) + "</root>"
-            )
+            elif event == "close":
+                # Client is signalling end of session/disconnect
+                self.send("</stream:stream>")  # Close stream
+                self._set_state("DISCONNECT")
 
-        else:
-            newdata = "<root>{}</root>".format(
-                data.decode("utf-8")
-            )  # Add artificial root
+            else:
+                await self._handle_stanza(item, raw.decode("utf-8"))
 
+    async def _handle_stanza(self, item, data):
         try:
-            root = ET.fromstring(newdata)
-            for item in root.iter():
-                if item.tag != "root":
-                    if item.tag == "iq":
-                        if self.log_incoming_data:
-                            xmppserverlog.debug(
-                                "from {} - {}".format(
-                                    self.address,
-                                    str(
-                                        ET.tostring(item, encoding="utf-8").decode(
-                                            "utf-8"
-                                        )
-                                    ).replace("ns0:", ""),
-                                )
-                            )
-                        self._handle_iq(item, newdata)
-                        item.clear()
-
-                    elif "auth" in item.tag:
-                        if "urn:ietf:params:xml:ns:xmpp-sasl" in item.tag:  # SASL Auth
-                            self._handle_sasl_auth(item)
-                            item.clear()
+            if item.tag == "iq":
+                if self.log_incoming_data:
+                    xmppserverlog.debug("from {} - {}".format(self.address, data))
+                await self._handle_iq(item, data)
 
-                    elif "presence" in item.tag:
-                        self._handle_presence(item)
-                        item.clear()
+            elif "auth" in item.tag:
+                if "urn:ietf:params:xml:ns:xmpp-sasl" in item.tag:  # SASL Auth
+                    await self._handle_sasl_auth(item)
 
-                    else:
-                        if self.log_incoming_data:
-                            xmppserverlog.debug(
-                                "Unparsed Item - {}".format(
-                                    str(
-                                        ET.tostring(item, encoding="utf-8").decode(
-                                            "utf-8"
-                                        )
-                                    ).replace("ns0:", "")
-                                )
-                            )
-
-        except ET.ParseError as e:
-            if (
-                "no element found" in e.msg
-            ):  # Element not closed or not all bytes received
-                # Happens wth connect stream often
-                if "<stream:stream " in newdata:
-                    if self.state == self.CONNECT or self.state == self.INIT:
-                        self._handle_connect(newdata.encode("utf-8"))
-                else:
-                    if not (newdata == "" or newdata == " "):
-                        xmppserverlog.error(
-                            "xml parse error - {} - {}".format(newdata, e)
-                        )
-
-            elif "not well-formed (invalid token)" in e.msg:
-                # If a lone </stream:stream> - client is signalling end of session/disconnect
-                if not "</stream:stream>" in newdata:
-                    xmppserverlog.error("xml parse error - {} - {}".format(newdata, e))
-                else:
-                    self.send("</stream:stream>")  # Close stream
+            elif "presence" in item.tag:
+                self._handle_presence(item)
 
             else:
-                if "<stream:stream" in newdata:  # Handle start stream and connect
-                    if self.state == self.CONNECT or self.state == self.INIT:
-                        xmppserverlog.debug(
-                            "Handling connect data - {}".format(newdata)
-                        )
-                        self._handle_connect(newdata.encode("utf-8"))
-                else:
-                    if not "</stream:stream>" in newdata:
-                        xmppserverlog.error(
-                            "xml parse error - {} - {}".format(newdata, e)
-                        )
-                    else:
-                        self.send("</stream:stream>")  # Close stream
-                        self._set_state("DISCONNECT")
+                if self.log_incoming_data:
+                    xmppserverlog.debug("Unparsed Item - {}".format(data))
 
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def _handle_iq(self, xml, data):
+    async def _handle_iq(self, xml, data):
         try:
             if len(xml):
                 child = self._tag_strip_uri(xml[0].tag)
@@ -876,7 +1244,7 @@ class Client(threading.Thread):
 
             if xml.tag == "iq":
                 if child == "bind":
-                    self._handle_bind(xml)
+                    await self._handle_bind(xml)
                 elif child == "session":
                     self._handle_session(xml)
                 elif child == "ping":
@@ -900,21 +1268,25 @@ class Client(threading.Thread):
         except Exception as e:
             xmppserverlog.exception("{}".format(e))
 
-    def run(self):
+    async def run(self):
         # xmppserverlog.info('client connected - {}'.format(self.address))
+        sending_client.set(self)
         self._set_state("CONNECT")
-        while not self.state == self.DISCONNECT and not self.connection._closed:
-            data = b""
-            time.sleep(0.1)
-            if not self.connection._closed:
-                try:
-                    data = self.connection.recv(4096)
-                    if data != b"":
-                        self._parse_data(data)
-                except ConnectionResetError as e:
-                    xmppserverlog.debug("{}".format(e))
-                except OSError as e:
-                    xmppserverlog.debug("{}".format(e))
-                except Exception as e:
-                    xmppserverlog.exception("{}".format(e))
-
+        while not self.state == self.DISCONNECT and not self.writer.is_closing():
+            try:
+                data = await self.reader.read(4096)
+                if data == b"":
+                    break  # Connection closed by client
+                await self._parse_data(data)
+                await self._wait_for_congested()
+            except ConnectionResetError as e:
+                xmppserverlog.debug("{}".format(e))
+                break
+            except OSError as e:
+                xmppserverlog.debug("{}".format(e))
+                break
+            except Exception as e:
+                xmppserverlog.exception("{}".format(e))
+
+        if not self.state == self.DISCONNECT:
+            self._set_state("DISCONNECT")
@@ -3,6 +3,8 @@
 import logging
 import bumper
 import sys, socket
+import os
+import signal
 import time
 import platform
 
@@ -23,6 +25,37 @@ def main():
             )
             # format="[%(asctime)s] :: %(levelname)s :: %(name)s :: %(module)s :: %(funcName)s :: %(lineno)d :: %(message)s")
 
+        if "--sqlite" in args:  # Use the SQLite storage backend
+            bumper.db_engine = "sqlite"
+
+        if "--conf-workers" in args:  # Serve HTTPS from N worker processes
+            bumper.conf_workers = int(args[args.index("--conf-workers") + 1])
+
+        if "--announce" in args:  # Address given to bots, instead of the hostname's
+            bumper.server_ip = args[args.index("--announce") + 1]
+
+    if bumper.conf_workers and not hasattr(socket, "SO_REUSEPORT"):
+        bumper.bumperlog.error("SO_REUSEPORT not supported, not starting conf workers")
+        bumper.conf_workers = 0
+
+    if bumper.conf_workers and bumper.db_engine != "sqlite":
+        # The TinyDB file can't be shared between processes
+        bumper.bumperlog.warning("Conf workers need the SQLite backend, using it")
+        bumper.db_engine = "sqlite"
+
+    conf_workers = []
+
+    def refresh_server_address(signum, frame):
+        bumper.refresh_server_address()
+        for worker in conf_workers:  # Workers keep their own copy
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGHUP)
+
+    # Resolve the announced address once, SIGHUP resolves it again
+    bumper.refresh_server_address()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, refresh_server_address)
+
     if platform.system() == "Darwin":  # If a Mac, use 0.0.0.0 for listening
         listen_host = "0.0.0.0"
     else:
@@ -40,12 +73,32 @@ def main():
     )
     mqtt_server = bumper.MQTTServer(mqtt_address)
     mqtt_helperbot = bumper.MQTTHelperBot(mqtt_address)
-    conf_server = bumper.ConfServer(
-        conf_address_443, usessl=True, helperbot=mqtt_helperbot
-    )
-    conf_server_2 = bumper.ConfServer(
-        conf_address_8007, usessl=False, helperbot=mqtt_helperbot
-    )
+    if bumper.conf_workers:
+        # Workers serve 443 and 8007, this one takes their forwarded bot commands
+        conf_server = bumper.ConfServer(
+            ("127.0.0.1", bumper.conf_owner_port), helperbot=mqtt_helperbot
+        )
+    else:
+        conf_server = bumper.ConfServer(
+            conf_address_443, usessl=True, helperbot=mqtt_helperbot
+        )
+        conf_server_2 = bumper.ConfServer(
+            conf_address_8007, usessl=False, helperbot=mqtt_helperbot
+        )
+
+    # Open the shared database handle used by all servers
+    bumper.db_open()
+
+    if bumper.conf_workers:
+        # After db_open() so a TinyDB migration is done once, before the
+        # workers open the database themselves
+        conf_workers.extend(
+            bumper.start_conf_workers(
+                [(conf_address_443, True), (conf_address_8007, False)],
+                bumper.conf_workers,
+                ("127.0.0.1", bumper.conf_owner_port),
+            )
+        )
 
     # add user
     # users = bumper.bumper_users_var.get()
@@ -69,8 +122,9 @@ def main():
     # start conf server on port 443 (async) - Used for most https calls
     conf_server.run(run_async=True)  # Start in new thread
 
-    # start conf server on port 8007 (async) - Used for a load balancer request
-    conf_server_2.run(run_async=True)  # Start in new thread
+    if not bumper.conf_workers:
+        # start conf server on port 8007 (async) - Used for a load balancer request
+        conf_server_2.run(run_async=True)  # Start in new thread
 
     while True:
         try:
@@ -79,9 +133,18 @@ def main():
             disconnected_clients = bumper.get_disconnected_xmpp_clients()
             for client in disconnected_clients:
                 xmpp_server.remove_client_byuid(client["userid"])
+            if not bumper.conf_workers:
+                # Workers log their own, this process serves no TLS then
+                bumper.bumperlog.debug(
+                    "TLS handshakes: {}".format(bumper.ssl_handshake_stats())
+                )
+            bumper.bumperlog.debug(
+                "HelperBot commands: {}".format(mqtt_helperbot.command_stats)
+            )
 
         except KeyboardInterrupt:
             bumper.bumperlog.info("Bumper Exiting - Keyboard Interrupt")
+            bumper.db_close()
             print("Bumper Exiting")
             exit(0)
 
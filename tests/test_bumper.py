@@ -2,11 +2,16 @@ from nose.tools import *
 import nose
 import mock
 from tinydb.storages import MemoryStorage
-from tinydb import TinyDB, Query
 import bumper
 import os
 import datetime, time
+import asyncio
+import threading
 import platform
+import socket
+import ssl
+import subprocess
+import sqlite3
 
 
 def test_get_milli_time():
@@ -21,6 +26,7 @@ def test_get_milli_time():
 
 
 def test_user_db():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
 
@@ -102,9 +108,7 @@ def test_user_db():
         len(bumper.user_get_tokens("testuser")), 0
     )  # Test 0 tokens are available
 
-    db = TinyDB("tests/tmp.db")
-    tokens = db.table("tokens")
-    tokens.insert(
+    bumper.db_get().token_insert(
         {
             "userid": "testuser",
             "token": "token_1234",
@@ -113,7 +117,6 @@ def test_user_db():
             ),
         }
     )  # Add expired token
-    db.close()
     assert_equals(
         len(bumper.user_get_tokens("testuser")), 1
     )  # Test 1 tokens are available
@@ -122,9 +125,7 @@ def test_user_db():
         len(bumper.user_get_tokens("testuser")), 0
     )  # Test 0 tokens are available
 
-    db = TinyDB("tests/tmp.db")
-    tokens = db.table("tokens")
-    tokens.insert(
+    bumper.db_get().token_insert(
         {
             "userid": "testuser",
             "token": "token_1234",
@@ -133,7 +134,6 @@ def test_user_db():
             ),
         }
     )  # Add expired token
-    db.close()
     assert_equals(
         len(bumper.user_get_tokens("testuser")), 1
     )  # Test 1 tokens are available
@@ -143,6 +143,42 @@ def test_user_db():
     )  # Test 0 tokens are available
 
 
+def test_db_handle():
+    bumper.db_close()
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    handle = bumper.db_get()
+    assert_true(bumper.db_get() is handle)  # Test that the handle is reused
+
+    bumper.db = "tests/tmp2.db"  # Changing location reopens the handle
+    assert_false(bumper.db_get() is handle)
+    assert_equals(bumper.db_handle_file, "tests/tmp2.db")
+
+    bumper.db_close()
+    assert_equals(bumper.db_handle, None)  # Test that the handle was closed
+    os.remove("tests/tmp2.db")
+
+    bumper.db = "tests/tmp.db"
+    bumper.db_flush()  # Flushing without an open handle is a no-op
+    bumper.user_add("flushuser")
+    bumper.db_flush()
+    with open("tests/tmp.db") as f:
+        assert_true("flushuser" in f.read())  # Test that the write reached disk
+
+
+def test_db_async():
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add("asyncuser")
+    loop = asyncio.get_event_loop()
+
+    user = loop.run_until_complete(bumper.user_get_async("asyncuser"))
+    assert_equals(user["userid"], "asyncuser")  # Test async variant returns result
+
+    thread = loop.run_until_complete(
+        bumper.db_run(lambda: threading.current_thread().name)
+    )
+    assert_true(thread.startswith("bumper_db"))  # Test that it ran off the loop
+
+
 def test_bot_db():
     bumper.db = "tests/tmp.db"  # Set db location for testing
     bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
@@ -167,6 +203,36 @@ def test_bot_db():
     assert_false(bumper.bot_get("did_123"))  # Test that bot is no longer in db
 
 
+def test_presence():
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.presence.clear()
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+
+    assert_false(bumper.presence.is_connected("bots", "did_123", "mqtt"))
+    assert_equals(bumper.presence.last_seen("bots", "did_123", "mqtt"), None)
+
+    bumper.bot_set_mqtt("did_123", True)
+    assert_true(bumper.presence.is_connected("bots", "did_123", "mqtt"))
+    assert_false(bumper.presence.is_connected("bots", "did_123", "xmpp"))
+    assert_true(bumper.presence.last_seen("bots", "did_123", "mqtt") <= time.time())
+    assert_true(
+        "mqtt_connection" not in bumper.db_get().bot_get("did_123")
+    )  # Test that connection state is not stored in the database
+    assert_true(bumper.bot_get("did_123")["mqtt_connection"])
+
+    bumper.client_add("user_123", "realm_123", "resource_123")
+    bumper.client_set_xmpp("resource_123", True)
+    assert_equals(len(bumper.get_disconnected_xmpp_clients()), 0)
+    bumper.client_set_xmpp("resource_123", False)
+    assert_equals(
+        bumper.get_disconnected_xmpp_clients()[0]["userid"], "user_123"
+    )  # Test that the disconnected client is returned with its record
+
+    bumper.bot_remove("did_123")
+    assert_false(bumper.presence.is_connected("bots", "did_123", "mqtt"))
+    bumper.presence.clear()
+
+
 def test_client_db():
     bumper.db = "tests/tmp.db"  # Set db location for testing
     bumper.client_add("user_123", "realm_123", "resource_123")
@@ -181,4 +247,313 @@ def test_client_db():
     assert_false(
         bumper.client_get("resource_123")["xmpp_connection"]
     )  # Test that xmpp was set False for client    
-    assert_equals(len(bumper.get_disconnected_xmpp_clients()), 1) # Test len of connected xmpp clients is 1
\ No newline at end of file
+    assert_equals(len(bumper.get_disconnected_xmpp_clients()), 1) # Test len of connected xmpp clients is 1
+
+def test_sqlite_db():
+    bumper.db_close()
+    for f in ("tests/tmp.db", "tests/tmp.sqlite3"):
+        if os.path.exists(f):
+            os.remove(f)  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.db_engine = "sqlite"
+    try:
+        assert_true(isinstance(bumper.db_get(), bumper.SQLiteStorage))
+        assert_equals(bumper.db_handle_file, "tests/tmp.sqlite3")
+
+        bumper.user_add("testuser")
+        bumper.user_add_device("testuser", "dev_1234")
+        assert_equals(
+            bumper.user_by_deviceid("dev_1234")["userid"], "testuser"
+        )  # Test that testuser was found by deviceid
+        bumper.user_add_device("testuser", "dev_5678")
+        bumper.user_remove_device("testuser", "dev_1234")
+        assert_equals(bumper.user_by_deviceid("dev_1234"), None)
+        assert_equals(bumper.user_by_deviceid("dev_5678")["userid"], "testuser")
+
+        # Databases from before the device lookup table get it filled in
+        bumper.db_close()
+        conn = sqlite3.connect("tests/tmp.sqlite3")
+        conn.execute("DROP TABLE user_devices")
+        conn.close()
+        assert_equals(bumper.user_by_deviceid("dev_5678")["userid"], "testuser")
+        bumper.user_add_device("testuser", "dev_1234")
+
+        bumper.user_add_token("testuser", "token_1234")
+        bumper.user_add_authcode("testuser", "token_1234", "auth_1234")
+        assert_true(bumper.check_token("fuid_testuser", "token_1234"))
+        assert_true(bumper.check_authcode("testuser", "auth_1234"))
+
+        bumper.user_add_token("testuser", "token_4321")
+        bumper.user_revoke_all_tokens("testuser")
+        assert_equals(len(bumper.user_get_tokens("testuser")), 0)
+
+        bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+        bumper.bot_set_mqtt("did_123", True)
+        assert_true(bumper.bot_get("did_123")["mqtt_connection"])
+        assert_equals(bumper.bot_get("did_123")["class"], "dev_123")
+        bumper.bot_remove("did_123")
+        assert_false(bumper.bot_get("did_123"))
+
+        bumper.client_add("user_123", "realm_123", "resource_123")
+        bumper.client_set_xmpp("resource_123", False)
+        assert_equals(len(bumper.get_disconnected_xmpp_clients()), 1)
+
+    finally:
+        bumper.db_close()
+        bumper.db_engine = "tinydb"
+        os.remove("tests/tmp.sqlite3")
+
+
+def test_sqlite_migration():
+    bumper.db_close()
+    for f in ("tests/tmp.db", "tests/tmp.sqlite3"):
+        if os.path.exists(f):
+            os.remove(f)  # Remove existing db
+
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    bumper.user_add("testuser")
+    bumper.user_add_device("testuser", "dev_1234")
+    bumper.user_add_token("testuser", "token_1234")
+    bumper.bot_add("sn_123", "did_123", "dev_123", "res_123", "co_123")
+    bumper.client_add("user_123", "realm_123", "resource_123")
+    bumper.db_close()
+
+    bumper.db_engine = "sqlite"
+    try:
+        # Opening the SQLite backend migrates the existing TinyDB file
+        assert_equals(bumper.user_by_deviceid("dev_1234")["userid"], "testuser")
+        assert_true(bumper.check_token("testuser", "token_1234"))
+        assert_equals(bumper.bot_get("did_123")["name"], "sn_123")
+        assert_true(bumper.client_get("resource_123"))
+
+        # Migration only runs once
+        bumper.bot_remove("did_123")
+        bumper.db_close()
+        assert_false(bumper.bot_get("did_123"))
+
+    finally:
+        bumper.db_close()
+        bumper.db_engine = "tinydb"
+        os.remove("tests/tmp.sqlite3")
+
+
+def test_tinydb_index():
+    if os.path.exists("tests/tmp_index.db"):
+        os.remove("tests/tmp_index.db")  # Remove existing db
+
+    storage = bumper.TinyDBStorage("tests/tmp_index.db")
+    storage.token_insert({"userid": "testuser", "token": "token_1234"})
+    storage.token_update("testuser", "token_1234", {"authcode": "auth_1234"})
+    assert_equals(len(storage.token_get_by_authcode("auth_1234")), 1)
+
+    storage.token_update("testuser", "token_1234", {"authcode": "auth_4321"})
+    assert_equals(
+        len(storage.token_get_by_authcode("auth_1234")), 0
+    )  # Test that the old authcode is no longer indexed
+    assert_equals(storage.token_get_by_token("token_1234")[0]["authcode"], "auth_4321")
+
+    storage.user_upsert({"userid": "testuser", "devices": ["dev_1234"], "bots": []})
+    storage.user_update("testuser", {"devices": ["dev_4321"]})
+    assert_equals(storage.user_by_deviceid("dev_1234"), None)
+    assert_equals(storage.user_by_deviceid("dev_4321")["userid"], "testuser")
+    storage.close()
+
+    # Test that indexes are rebuilt from the file on open
+    storage = bumper.TinyDBStorage("tests/tmp_index.db")
+    assert_equals(storage.user_by_deviceid("dev_4321")["userid"], "testuser")
+    assert_equals(storage.token_get("testuser", "token_1234")["authcode"], "auth_4321")
+    storage.token_remove([("testuser", "token_1234")])
+    assert_equals(storage.token_get_by_token("token_1234"), [])
+    storage.close()
+    os.remove("tests/tmp_index.db")
+
+
+def test_token_expiry():
+    for engine in ("tinydb", "sqlite"):
+        bumper.db_close()
+        for f in ("tests/tmp.db", "tests/tmp.sqlite3"):
+            if os.path.exists(f):
+                os.remove(f)  # Remove existing db
+
+        bumper.db = "tests/tmp.db"  # Set db location for testing
+        bumper.db_engine = engine
+        try:
+            storage = bumper.db_get()
+            now = time.time()
+            for i in range(5):  # Expired tokens
+                storage.token_insert(
+                    {
+                        "userid": "user_{}".format(i % 2),
+                        "token": "old_{}".format(i),
+                        "expiration": now - 10 - i,
+                    }
+                )
+            storage.token_insert(
+                {"userid": "user_0", "token": "new_0", "expiration": now + 3600}
+            )
+
+            assert_equals(len(storage.token_remove_expired(now, "user_1")), 2)
+            assert_equals(len(bumper.user_get_tokens("user_0")), 4)
+
+            # Token expiration moved forward is not removed
+            storage.token_update("user_0", "old_0", {"expiration": now + 3600})
+
+            bumper.revoke_expired_tokens()
+            assert_equals(len(storage.token_get_all()), 2)
+            assert_true(bumper.check_token("user_0", "old_0"))
+            assert_true(bumper.check_token("user_0", "new_0"))
+            assert_equals(storage.token_remove_expired(now), [])
+
+            # Test a token inserted twice with one expiration is removed once
+            for _ in range(2):
+                storage.token_insert(
+                    {"userid": "user_2", "token": "dup_0", "expiration": now - 10}
+                )
+            assert_equals(
+                [tuple(key) for key in storage.token_remove_expired(now)],
+                [("user_2", "dup_0")],
+            )
+
+        finally:
+            bumper.db_close()
+            bumper.db_engine = "tinydb"
+            if os.path.exists("tests/tmp.sqlite3"):
+                os.remove("tests/tmp.sqlite3")
+
+
+def test_ssl_server_context():
+    # The repository certs use a digest newer OpenSSL builds reject, so make
+    # a throwaway pair for the test
+    cert, key = "tests/tmp_cert.pem", "tests/tmp_key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    server_cert, server_key = bumper.server_cert, bumper.server_key
+    bumper.server_cert, bumper.server_key = cert, key
+    try:
+        context = bumper.ssl_server_context()
+        # Every listener gets the same context
+        assert context is bumper.ssl_server_context()
+        assert_equals(
+            bumper.ssl_handshake_stats(), {"full": 0, "resumed": 0, "incomplete": 0}
+        )
+
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+
+        def serve():
+            for _ in range(3):
+                conn, _ = listener.accept()
+                with context.wrap_socket(conn, server_side=True) as tls:
+                    tls.sendall(b"ok")
+                    tls.recv(1)
+
+        server = threading.Thread(target=serve)
+        server.start()
+
+        client_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client_ctx.check_hostname = False
+        client_ctx.verify_mode = ssl.CERT_NONE
+        session = None
+        for _ in range(3):
+            conn = socket.create_connection(listener.getsockname())
+            with client_ctx.wrap_socket(conn, session=session) as tls:
+                tls.recv(2)  # Session tickets arrive after the handshake
+                session = tls.session
+                tls.sendall(b"x")
+        server.join()
+        listener.close()
+
+        # First connect is a full handshake, reconnects resume
+        assert_equals(
+            bumper.ssl_handshake_stats(), {"full": 1, "resumed": 2, "incomplete": 0}
+        )
+
+    finally:
+        bumper.server_cert, bumper.server_key = server_cert, server_key
+        bumper.ssl_context = None
+        bumper.ssl_context_files = None
+        os.remove(cert)
+        os.remove(key)
+
+
+def test_server_address():
+    with mock.patch("socket.gethostbyname", return_value="10.0.0.1") as resolve:
+        bumper.server_address_resolved = None
+        assert_equals(bumper.server_address(), "10.0.0.1")
+        assert_equals(bumper.server_address(), "10.0.0.1")
+        assert_equals(resolve.call_count, 1)  # Resolved once
+
+        # Configured address wins over the hostname
+        bumper.server_ip = "192.168.1.10"
+        assert_equals(bumper.server_address(), "10.0.0.1")  # Until refreshed
+        assert_equals(bumper.refresh_server_address(), "192.168.1.10")
+        assert_equals(bumper.server_address(), "192.168.1.10")
+        assert_equals(resolve.call_count, 1)
+
+    bumper.server_ip = None
+    bumper.server_address_resolved = None
+
+
+def test_bot_list():
+    for engine in ("tinydb", "sqlite"):
+        bumper.db_close()
+        for f in ("tests/tmp.db", "tests/tmp.sqlite3"):
+            if os.path.exists(f):
+                os.remove(f)  # Remove existing db
+        bumper.db = "tests/tmp.db"  # Set db location for testing
+        bumper.db_engine = engine
+        bumper.presence.clear()
+        try:
+            for i in range(5):
+                bumper.bot_add("sn_{}".format(i), "did_{}".format(i), "c", "r", "co")
+            bumper.bot_set_mqtt("did_3", True)
+
+            total, bots = bumper.bot_list()
+            assert_equals(total, 5)
+            assert_equals(
+                [bot["did"] for bot in bots], ["did_{}".format(i) for i in range(5)]
+            )
+            assert_true(bots[3]["mqtt_connection"])
+
+            total, bots = bumper.bot_list(fields=["did", "name"], offset=1, limit=2)
+            assert_equals(total, 5)
+            assert_equals(
+                bots,
+                [{"did": "did_1", "name": "sn_1"}, {"did": "did_2", "name": "sn_2"}],
+            )
+
+            bumper.user_add("testuser")
+            with mock.patch.object(
+                bumper.db_get(), "user_update", wraps=bumper.db_get().user_update
+            ) as user_update:
+                bumper.user_add_bots("testuser", ["did_3", "did_1", "gone", "did_1"])
+                bumper.user_add_bots("testuser", ["did_1", "did_3"])  # No change
+                assert_equals(user_update.call_count, 1)  # One write for all bots
+            assert_equals(
+                bumper.user_get("testuser")["bots"], ["did_3", "did_1", "gone"]
+            )
+
+            total, bots = bumper.bot_list("testuser", ["did", "mqtt_connection"])
+            assert_equals(total, 2)  # Bots no longer in the database are skipped
+            assert_equals(
+                bots,
+                [
+                    {"did": "did_1", "mqtt_connection": False},
+                    {"did": "did_3", "mqtt_connection": True},
+                ],
+            )
+            assert_equals(bumper.bot_list("nobody"), (0, []))
+
+        finally:
+            bumper.db_close()
+            bumper.db_engine = "tinydb"
+            bumper.presence.clear()
+            if os.path.exists("tests/tmp.sqlite3"):
+                os.remove("tests/tmp.sqlite3")
@@ -5,6 +5,9 @@ import asyncio
 import os
 import json
 import tinydb
+import socket
+import signal
+import aiohttp
 from aiohttp.test_utils import TestClient, TestServer, loop_context
 from aiohttp import request
 
@@ -21,6 +24,7 @@ def test_disconnect():
     confserver.disconnect()
 
 def test_base():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -44,6 +48,7 @@ def test_base():
 
 
 def test_login():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -84,6 +89,7 @@ def test_login():
 
 
 def test_logout():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -119,6 +125,7 @@ def test_logout():
 
 
 def test_checkLogin():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -173,6 +180,7 @@ def test_checkLogin():
 
 
 def test_getAuthCode():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -220,6 +228,7 @@ def test_getAuthCode():
 
 
 def test_checkAgreement():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -249,6 +258,7 @@ def test_checkAgreement():
 
 
 def test_homePageAlert():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -278,6 +288,7 @@ def test_homePageAlert():
 
 
 def test_checkVersion():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -307,6 +318,7 @@ def test_checkVersion():
 
 
 def test_getProductIotMap():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -334,6 +346,7 @@ def test_getProductIotMap():
 
 
 def test_getUsersAPI():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -361,6 +374,7 @@ def test_getUsersAPI():
 
 
 def test_postUsersAPI():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -423,6 +437,28 @@ def test_postUsersAPI():
     }
     loop.run_until_complete(test_handle_postUsersApi(postbody))
 
+    # Test GetDeviceList with projection and pagination
+    async def test_handle_getDeviceList(postbody):
+        resp = await client.post("/api/users/user.do", json=postbody)
+        jsonresp = json.loads(await resp.text())
+        assert_equals(jsonresp["total"], 1)
+        assert_equals(jsonresp["devices"], [{"did": "did_1234", "nick": ""}])
+
+    postbody = dict(postbody, owner="fuid_testuser", fields=["did", "nick"], limit=10)
+    loop.run_until_complete(test_handle_getDeviceList(postbody))
+
+    # Bots added after login are listed, the app's userid does not filter
+    async def test_handle_getDeviceList_all(postbody):
+        resp = await client.post("/api/users/user.do", json=postbody)
+        jsonresp = json.loads(await resp.text())
+        dids = [device["did"] for device in jsonresp["devices"]]
+        assert "did_1234" in dids
+        assert "did_5678" in dids
+
+    bumper.bot_add("sn_5678", "did_5678", "class_5678", "res_5678", "com_5678")
+    postbody = {"todo": "GetDeviceList", "userid": "fuid_testuser"}
+    loop.run_until_complete(test_handle_getDeviceList_all(postbody))
+
     # Test SetDeviceNick
     postbody = {
         "auth": {
@@ -473,6 +509,7 @@ def test_postUsersAPI():
 
 
 def test_postLookup():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -486,6 +523,11 @@ def test_postLookup():
 
         assert resp.status == 200
         text = await resp.text()
+        # Test headers match web.json_response
+        assert_equals(resp.headers["Content-Type"], "application/json; charset=utf-8")
+        if postbody["service"] == "EcoMsgNew":
+            assert " " not in text  # Bots reject bodies with spaces
+            assert_equals(json.loads(text)["ip"], bumper.server_address())
         jsonresp = json.loads(text)
         if jsonresp:
             assert jsonresp["result"] == "ok"
@@ -507,6 +549,7 @@ def test_postLookup():
     )  # Close test server after all tests are done
 
 def test_devmgr():
+    bumper.db_close()  # Close any open handle before removing the db
     if os.path.exists("tests/tmp.db"):
         os.remove("tests/tmp.db")  # Remove existing db
     bumper.db = "tests/tmp.db"  # Set db location for testing
@@ -564,3 +607,187 @@ def test_devmgr():
     loop.run_until_complete(
         client.close()
     )  # Close test server after all tests are done
+
+
+def test_response_template():
+    template = bumper.confserver.ResponseTemplate(
+        {"code": bumper.RETURN_API_SUCCESS, "data": [], "msg": "操作成功", "time": 0}
+    )
+    body = json.loads(template.render())
+    assert_equals(body["code"], bumper.RETURN_API_SUCCESS)
+    assert_equals(body["msg"], "操作成功")
+    assert isinstance(body["time"], int) and body["time"] > 0
+
+    # Without a time field the body is static
+    template = bumper.confserver.ResponseTemplate({"code": bumper.RETURN_API_SUCCESS})
+    assert template.render() is template.render()
+
+
+def test_private_routes():
+    loop = asyncio.get_event_loop()
+    client = TestClient(TestServer(app), loop=loop)
+    loop.run_until_complete(client.start_server())
+
+    async def test_handle_private():
+        resp = await client.get(
+            "/1/private/us/en/dev_1234/ios/1/0/0/user/checkAgreement"
+        )
+        assert resp.status == 200
+        # Test headers match web.json_response
+        assert_equals(resp.headers["Content-Type"], "application/json; charset=utf-8")
+
+        # Unknown endpoints, partial paths and paths past a handler are not found
+        for path in ("user/nothing", "user", "user/checkAgreement/more", "other/x"):
+            resp = await client.get("/1/private/us/en/dev_1234/ios/1/0/0/" + path)
+            assert resp.status == 404
+
+        resp = await client.post(
+            "/1/private/us/en/dev_1234/ios/1/0/0/user/checkAgreement"
+        )
+        assert resp.status == 405
+
+    loop.run_until_complete(test_handle_private())
+
+    loop.run_until_complete(client.close())
+
+
+def test_devmgr_forward():
+    # A worker forwards bot commands to the ConfServer owning the helper bot
+    loop = asyncio.get_event_loop()
+    owner = TestServer(app, loop=loop)
+    loop.run_until_complete(owner.start_server())
+
+    worker = bumper.ConfServer(
+        ("127.0.0.1", 0), False, forward_to=("127.0.0.1", owner.port)
+    )
+    worker.confserver_app()
+    client = TestClient(TestServer(worker.app), loop=loop)
+    loop.run_until_complete(client.start_server())
+
+    async def test_forward():
+        resp = await client.post("/api/iot/devmanager.do", json={"td": "PollSCResult"})
+        assert resp.status == 200
+        assert_equals(json.loads(await resp.text()), {"ret": "ok"})
+
+    loop.run_until_complete(test_forward())
+
+    # Device lists come from the owner, which knows the connection state
+    bumper.bot_add("sn_1234", "did_1234", "dev_1234", "res_1234", "eco-ng")
+    bumper.bot_set_mqtt("did_1234", True)
+
+    async def test_forward_devicelist():
+        postbody = {"todo": "GetDeviceList", "userid": "fuid_testuser"}
+        resp = await client.post("/api/users/user.do", json=postbody)
+        jsonresp = json.loads(await resp.text())
+        device = [d for d in jsonresp["devices"] if d["did"] == "did_1234"][0]
+        assert device["mqtt_connection"]
+
+    # Deleting a bot clears its connection state in the owner
+    bumper.bot_add("sn_5678", "did_5678", "dev_5678", "res_5678", "eco-ng")
+    bumper.bot_set_mqtt("did_5678", True)
+
+    async def test_forward_delete():
+        postbody = {"todo": "DeleteOneDevice", "did": "did_5678"}
+        resp = await client.post("/api/users/user.do", json=postbody)
+        assert_equals(json.loads(await resp.text())["result"], "ok")
+
+    with mock.patch.object(
+        worker, "forward_request", wraps=worker.forward_request
+    ) as forward:
+        loop.run_until_complete(test_forward_devicelist())
+        loop.run_until_complete(test_forward_delete())
+        assert_equals(forward.call_count, 2)
+    assert_equals(bumper.bot_get("did_5678"), None)
+    assert_false(bumper.presence.is_connected("bots", "did_5678", "mqtt"))
+    bumper.bot_set_mqtt("did_1234", False)
+    session = worker.forward_session
+
+    # An unreachable owner is logged and answered with a failure
+    loop.run_until_complete(owner.close())
+
+    async def test_forward_fail():
+        resp = await client.post("/api/iot/devmanager.do", json={"toId": "did_1"})
+        assert resp.status == 200
+        assert_equals(json.loads(await resp.text())["ret"], "fail")
+
+    with mock.patch.object(bumper.confserver.confserverlog, "exception") as log:
+        loop.run_until_complete(test_forward_fail())
+        assert_equals(log.call_count, 1)
+
+    loop.run_until_complete(client.close())
+    assert session.closed  # Closed with the app
+    assert_equals(worker.forward_session, None)
+
+
+def test_log_handshake_stats():
+    loop = asyncio.new_event_loop()
+    with mock.patch.object(bumper.bumperlog, "debug") as debug:
+        bumper.confserver.log_handshake_stats(loop, 0.01)
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+    # Test stats are logged at once and again every interval
+    assert debug.call_count >= 3
+    assert_true(debug.call_args[0][0].startswith("TLS handshakes: "))
+    loop.close()
+
+
+def test_conf_workers():
+    bumper.db_close()
+    if os.path.exists("tests/tmp.sqlite3"):
+        os.remove("tests/tmp.sqlite3")
+    bumper.db = "tests/tmp.db"
+    bumper.db_engine = "sqlite"
+    bumper.db_open()  # Create the database before the workers share it
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    address = sock.getsockname()
+    sock.close()
+
+    bumper.server_address_resolved = "10.9.9.9"  # Workers start with this copy
+    workers = bumper.start_conf_workers([(address, False)], 2, ("127.0.0.1", 1))
+    try:
+
+        async def test_workers():
+            url = "http://{}:{}/1/private/us/en/dev_1234/ios/1/0/0/user/login"
+            for _ in range(100):  # Workers take a moment to start
+                try:
+                    async with request("GET", url.format(*address)) as resp:
+                        jsonresp = json.loads(await resp.text())
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+            assert_equals(jsonresp["code"], bumper.RETURN_API_SUCCESS)
+
+            # The login done by a worker is visible to this process
+            user = bumper.user_by_deviceid("dev_1234")
+            assert bumper.check_token(user["userid"], jsonresp["data"]["accessToken"])
+
+            async def lookup():
+                url = "http://{}:{}/lookup.do".format(*address)
+                postbody = {"todo": "FindBest", "service": "EcoMsgNew"}
+                async with request("POST", url, json=postbody) as resp:
+                    return json.loads(await resp.text())["ip"]
+
+            assert_equals(await lookup(), "10.9.9.9")
+
+            # SIGHUP makes each worker resolve the address again
+            for worker in workers:
+                os.kill(worker.pid, signal.SIGHUP)
+            resolved = socket.gethostbyname(socket.gethostname())
+            for _ in range(50):
+                ips = [await lookup() for _ in range(10)]
+                if ips == [resolved] * 10:
+                    break
+                await asyncio.sleep(0.1)
+            assert_equals(ips, [resolved] * 10)
+
+        asyncio.get_event_loop().run_until_complete(test_workers())
+
+    finally:
+        bumper.server_address_resolved = None
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        bumper.db_close()
+        bumper.db_engine = "tinydb"
+        os.remove("tests/tmp.sqlite3")
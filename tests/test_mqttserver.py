@@ -0,0 +1,168 @@
+from nose.tools import *
+import mock
+import bumper
+import asyncio
+import threading
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.data = payload.encode()
+
+
+def make_helperbot():
+    helperbot = bumper.MQTTHelperBot(("127.0.0.1", 8883))
+    helperbot.Client = mock.MagicMock()
+    helperbot.messages = asyncio.Queue()
+
+    async def publish(topic, payload, qos):
+        # Answer the command like a bot would, with the request id from the topic
+        parts = topic.split("/")
+        resptopic = "iot/p2p/{}/{}/{}/{}/helper1/bumper/helper1/p/{}/j".format(
+            parts[2], parts[6], parts[7], parts[8], parts[10]
+        )
+        if parts[2] != "NoAnswer":
+            await helperbot.messages.put(FakeMessage(resptopic, '{"ret": "ok"}'))
+
+    helperbot.Client.publish = publish
+    helperbot.Client.deliver_message = helperbot.messages.get
+    return helperbot
+
+
+def test_helperbot_send_command():
+    loop = asyncio.get_event_loop()
+    helperbot = make_helperbot()
+    receiver = loop.create_task(helperbot.get_msg())
+
+    cmd = {
+        "cmdName": "GetCleanState",
+        "toId": "did_1234",
+        "toType": "ls1ok3",
+        "toRes": "res_1234",
+        "payloadType": "j",
+        "payload": {},
+    }
+    resp = loop.run_until_complete(helperbot.send_command(cmd, "req_1"))
+    assert_equals(resp, {"id": "req_1", "ret": "ok", "resp": {"ret": "ok"}})
+    assert_equals(helperbot.pending_responses, {})  # Test future was cleaned up
+
+    helperbot.command_timeout = 0.1
+    cmd["cmdName"] = "NoAnswer"
+    resp = loop.run_until_complete(helperbot.send_command(cmd, "req_2"))
+    assert_equals(resp["errno"], "timeout")
+    assert_equals(helperbot.pending_responses, {})
+
+    receiver.cancel()
+    loop.run_until_complete(asyncio.wait([receiver]))  # Let the receiver exit
+
+
+def test_helperbot_coalesce():
+    loop = asyncio.get_event_loop()
+    helperbot = make_helperbot()
+    receiver = loop.create_task(helperbot.get_msg())
+    publish = helperbot.Client.publish
+    published = []
+
+    async def counting_publish(topic, payload, qos):
+        published.append(topic)
+        await publish(topic, payload, qos)
+
+    helperbot.Client.publish = counting_publish
+
+    def command(name, payload):
+        return {
+            "cmdName": name,
+            "toId": "did_1234",
+            "toType": "ls1ok3",
+            "toRes": "res_1234",
+            "payloadType": "j",
+            "payload": payload,
+        }
+
+    async def send(cmd, count):
+        return await asyncio.gather(
+            *[helperbot.send_command(cmd, "req_{}".format(i)) for i in range(count)]
+        )
+
+    # Concurrent identical queries share one round trip, each keeps its id
+    resps = loop.run_until_complete(send(command("getBattery", {"a": 1}), 5))
+    assert_equals(len(published), 1)
+    assert_equals([r["id"] for r in resps], ["req_{}".format(i) for i in range(5)])
+    assert_true(all(r["resp"] == {"ret": "ok"} for r in resps))
+    assert_equals(helperbot.inflight_commands, {})
+
+    # Answered from the result cache until it expires
+    loop.run_until_complete(send(command("getBattery", {"a": 1}), 1))
+    assert_equals(len(published), 1)
+    loop.run_until_complete(send(command("getBattery", {"a": 2}), 1))
+    assert_equals(len(published), 2)  # Different payload
+
+    helperbot.result_ttl = 0
+    helperbot.command_results.clear()
+    loop.run_until_complete(send(command("getBattery", {"a": 1}), 1))
+    loop.run_until_complete(send(command("getBattery", {"a": 1}), 1))
+    assert_equals(len(published), 4)
+
+    # Commands that change state are always sent
+    loop.run_until_complete(send(command("clean", {"act": "go"}), 3))
+    assert_equals(len(published), 7)
+    assert_equals(helperbot.command_stats, {"sent": 7, "coalesced": 4, "cached": 1})
+
+    receiver.cancel()
+    loop.run_until_complete(asyncio.wait([receiver]))  # Let the receiver exit
+
+
+def test_helperbot_cross_loop():
+    helperbot = make_helperbot()
+    hloop = asyncio.new_event_loop()
+
+    async def start_receiver():
+        helperbot.messages = asyncio.Queue()  # Bind the queue to the helper loop
+        helperbot.Client.deliver_message = helperbot.messages.get
+        return hloop.create_task(helperbot.get_msg())
+
+    receiver = hloop.run_until_complete(start_receiver())
+    helperbot.loop = hloop
+    helperthread = threading.Thread(target=hloop.run_forever)
+    helperthread.start()
+
+    cmd = {
+        "cmdName": "GetBatteryInfo",
+        "toId": "did_1234",
+        "toType": "ls1ok3",
+        "toRes": "res_1234",
+        "payloadType": "j",
+        "payload": {},
+    }
+
+    async def send_commands():
+        # Commands sent concurrently from another loop, as the ConfServers do
+        return await asyncio.gather(
+            *[helperbot.send_command(cmd, "req_{}".format(i)) for i in range(10)]
+        )
+
+    loop = asyncio.new_event_loop()
+    resps = loop.run_until_complete(send_commands())
+    loop.close()
+    assert_equals([r["id"] for r in resps], ["req_{}".format(i) for i in range(10)])
+    assert_true(all(r["ret"] == "ok" for r in resps))
+
+    hloop.call_soon_threadsafe(hloop.stop)
+    helperthread.join()
+    receiver.cancel()
+    hloop.run_until_complete(asyncio.wait([receiver]))  # Let the receiver exit
+    hloop.close()
+
+
+def test_response_stats():
+    responses = bumper.mqttserver.ResponseStats(capacity=3)
+    for i in range(5):
+        responses.timed_out("req_{}".format(i))
+    assert_equals(list(responses.timeouts), ["req_2", "req_3", "req_4"])  # Test capacity
+
+    responses.add("req_4")
+    responses.add("req_4")
+    responses.add("req_0")  # Forgotten, no longer counted as late
+    assert_equals(responses.stats["late"], 1)  # Test late response was counted once
+    assert_equals(responses.stats["unmatched"], 3)
@@ -0,0 +1,409 @@
+from nose.tools import *
+import mock
+import bumper
+import asyncio
+import base64
+import socket
+import uuid
+import os
+
+STREAM_HEADER = '<stream:stream to="{}" xmlns="jabber:client" xmlns:stream="http://etherx.jabber.org/streams" version="1.0">'
+
+
+class XMPPTestClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.received = ""
+
+    def send(self, data):
+        self.writer.write(data.encode())
+
+    async def expect(self, text, timeout=2):
+        # Read until text shows up, then consume everything up to it
+        while text not in self.received:
+            data = await asyncio.wait_for(self.reader.read(4096), timeout)
+            if data == b"":
+                raise ConnectionError("connection closed waiting for {}".format(text))
+            self.received += data.decode("utf-8")
+        _, _, self.received = self.received.partition(text)
+
+    def close(self):
+        self.writer.close()
+
+
+async def xmpp_login(port, local_ip, uid, to, sasl):
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", port, local_addr=(local_ip, 0)
+    )
+    client = XMPPTestClient(reader, writer)
+    client.send(STREAM_HEADER.format(to))
+    await client.expect("</stream:features>")
+    client.send(
+        '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" mechanism="PLAIN">{}</auth>'.format(
+            base64.b64encode(sasl.encode()).decode()
+        )
+    )
+    await client.expect("<success")
+    client.send(STREAM_HEADER.format(to))
+    await client.expect("</stream:features>")
+    client.send(
+        '<iq type="set" id="1"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><resource>{}</resource></bind></iq>'.format(
+            uid
+        )
+    )
+    await client.expect("</jid>")
+    client.send(
+        '<iq type="set" id="2"><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></iq>'
+    )
+    await client.expect('id="2"')
+    return client
+
+
+def start_xmppserver(loop):
+    xmppserver = bumper.XMPPServer(("127.0.0.1", 0), usessl=False)
+    loop.run_until_complete(xmppserver.start_server())
+    port = xmppserver.socket.getsockname()[1]
+    return xmppserver, port
+
+
+def test_xmppserver_ctl_roundtrip():
+    bumper.db_close()  # Close any open handle before removing the db
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+
+    loop = asyncio.get_event_loop()
+    xmppserver, port = start_xmppserver(loop)
+
+    async def roundtrip():
+        bot = await xmpp_login(
+            port, "127.0.0.2", "did_1234", "ls1ok3.ecorobot.net", "\x00did_1234\x000"
+        )
+        controller = await xmpp_login(
+            port,
+            "127.0.0.3",
+            "fuid_1234",
+            "ecouser.net",
+            "\x00fuid_1234\x00/resource_1234/authcode_1234",
+        )
+        # Test both connections are served by the same loop
+        assert_equals(len(xmppserver.clients), 2)
+        assert_true(bumper.presence.is_connected("bots", "did_1234", "xmpp"))
+
+        controller.send(
+            '<iq type="set" id="3" to="did_1234@ls1ok3.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="GetCleanState"/></query></iq>'
+        )
+        # Test ctl forwarded to bot, from the controller's full JID
+        await bot.expect('<iq from="fuid_1234@ecouser.net/fuid_1234"')
+        await bot.expect('td="GetCleanState"')
+
+        bot.send(
+            '<iq type="result" id="3" to="fuid_1234@ecouser.net/resource_1234"><query xmlns="com:ctl"><ctl ret="ok"><clean type="auto"/></ctl></query></iq>'
+        )
+        await controller.expect('<clean type="auto"')  # Test result forwarded
+
+        # Test a new connection from the bot's ip evicts the old session
+        _, writer = await asyncio.open_connection(
+            "127.0.0.1", port, local_addr=("127.0.0.2", 0)
+        )
+        assert_equals(await asyncio.wait_for(bot.reader.read(4096), 2), b"")
+        assert_equals(xmppserver.clients.by_uid("did_1234"), [])
+
+        writer.close()
+        controller.close()
+        bot.close()
+
+    loop.run_until_complete(roundtrip())
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert_equals(len(xmppserver.clients), 0)  # Test closed clients were removed
+    assert_equals(xmppserver.clients.by_uid("did_1234"), [])  # Test index cleared
+    assert_false(bumper.presence.is_connected("bots", "did_1234", "xmpp"))
+
+    assert_equals(xmppserver.accept_stats["accepted"], 3)
+    assert_equals(xmppserver.accept_stats["connected"], 3)
+    xmppserver.close()
+
+
+def test_xmppserver_plaintext():
+    loop = asyncio.get_event_loop()
+    # Constructed as start_bumper does, bots connect without TLS
+    xmppserver = bumper.XMPPServer(("127.0.0.1", 0))
+    loop.run_until_complete(xmppserver.start_server())
+    port = xmppserver.socket.getsockname()[1]
+
+    async def connect():
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", port, local_addr=("127.0.3.1", 0)
+        )
+        client = XMPPTestClient(reader, writer)
+        client.send(STREAM_HEADER.format("ecouser.net"))
+        await client.expect("<stream:stream")  # Test plaintext stream reply
+        await client.expect("</stream:features>")
+        client.close()
+
+    loop.run_until_complete(connect())
+    xmppserver.close()
+
+
+def test_xmppserver_accept():
+    loop = asyncio.get_event_loop()
+    bumper.xmpp_ip_rate_limit = (2, 60)
+    try:
+        xmppserver, port = start_xmppserver(loop)
+    finally:
+        bumper.xmpp_ip_rate_limit = None
+
+    async def storm():
+        # Test every connection in the backlog is accepted in one wakeup
+        xmppserver.loop.remove_reader(xmppserver.socket.fileno())
+        connections = [
+            await asyncio.open_connection(
+                "127.0.0.1", port, local_addr=("127.0.1.{}".format(i), 0)
+            )
+            for i in range(1, 11)
+        ]
+        xmppserver._resume_accepting()
+        await asyncio.sleep(0.1)
+        assert_equals(xmppserver.accept_stats["accepted"], 10)
+        assert_equals(xmppserver.accept_stats["max_batch"], 10)
+        if hasattr(socket, "TCP_INFO"):
+            assert_equals(xmppserver.accept_stats["max_queue_depth"], 10)
+
+        # Test connections from one ip over the rate limit are closed
+        more = [
+            await asyncio.open_connection(
+                "127.0.0.1", port, local_addr=("127.0.2.1", 0)
+            )
+            for i in range(3)
+        ]
+        assert_equals(await asyncio.wait_for(more[2][0].read(), 1), b"")
+        assert_equals(xmppserver.accept_stats["rate_limited"], 1)
+
+        for _, writer in connections + more:
+            writer.close()
+
+    loop.run_until_complete(storm())
+    xmppserver.close()
+
+
+def test_connection_rate_limiter():
+    limiter = bumper.xmppserver.ConnectionRateLimiter(2, 10)
+    assert_true(limiter.allow("10.0.0.1", 100))
+    assert_true(limiter.allow("10.0.0.1", 100))
+    assert_false(limiter.allow("10.0.0.1", 100))  # Test burst is enforced
+    assert_true(limiter.allow("10.0.0.2", 100))  # Test limits are per ip
+    assert_false(limiter.allow("10.0.0.1", 104))
+    assert_true(limiter.allow("10.0.0.1", 105))  # Test tokens refill over time
+
+    limiter.prune(200)
+    assert_equals(limiter.buckets, {})  # Test refilled buckets are pruned
+
+
+def test_stream_parser():
+    parser = bumper.xmppserver.StreamParser()
+    data = (
+        "<?xml version='1.0'?>"
+        + STREAM_HEADER.format("ls1ok3.ecorobot.net")
+        + "<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='PLAIN'>AGRpZAAw</auth> "
+        + "<?xml version='1.0'?>"  # Restarted stream after authentication
+        + STREAM_HEADER.format("ls1ok3.ecorobot.net")
+        + "<iq type='set' id='1'><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/></iq>"
+        + "<presence><status>hello world</status></presence>"
+        + "<iq type='result' id='2'/>"
+        + "</stream:stream>"
+    ).encode()
+
+    # Test stanzas split across reads are only returned once complete
+    events = []
+    for i in range(0, len(data), 7):
+        events.extend(parser.feed(data[i : i + 7]))
+
+    assert_equals(
+        [event for event, _, _ in events],
+        ["stream", "stanza", "stream", "stanza", "stanza", "stanza", "close"],
+    )
+    assert_true(events[0][2].startswith(b"<stream:stream "))
+    assert_equals(events[1][1].tag, "{urn:ietf:params:xml:ns:xmpp-sasl}auth")
+    assert_equals(events[1][1].text, "AGRpZAAw")
+    assert_equals(events[3][1].tag, "iq")  # Test stream namespace is stripped
+    assert_equals(events[4][1][0].tag, "status")
+    assert_equals(events[4][2], b"<presence><status>hello world</status></presence>")
+    assert_equals(events[5][2], b"<iq type='result' id='2'/>")  # Test raw bytes
+
+
+def make_client(client_id, address, uid, resource, jid):
+    return mock.MagicMock(
+        id=client_id,
+        address=address,
+        uid=uid,
+        clientresource=resource,
+        bumper_jid=jid,
+        registry_keys=None,
+    )
+
+
+def test_client_registry():
+    clients = bumper.xmppserver.ClientRegistry()
+    bot = make_client(1, "10.0.0.1", "did_1234", "atom", "")
+    app1 = make_client(2, "10.0.0.2", "", "", "")
+    app2 = make_client(3, "10.0.0.3", "fuid_1234", "resource_2", "")
+    for client in (bot, app1, app2):
+        clients.add(client)
+
+    # Test connected clients are found by id and ip before binding
+    assert_equals(len(clients), 3)
+    assert_equals(clients.get(2), app1)
+    assert_equals(clients.by_ip("10.0.0.2"), [app1])
+    assert_equals(clients.by_uid("FUID_1234"), [app2])
+    assert_equals(clients.by_jid("did_1234@ls1ok3.ecorobot.net"), [])
+
+    # Test bound clients are reindexed by jid, uid and resource
+    bot.bumper_jid = "did_1234@ls1ok3.ecorobot.net/atom"
+    app1.uid = "fuid_1234"
+    app1.clientresource = "resource_1"
+    app1.bumper_jid = "fuid_1234@ecouser.net/resource_1"
+    app2.bumper_jid = "fuid_1234@ecouser.net/resource_2"
+    for client in (bot, app1, app2):
+        clients.update(client)
+
+    assert_equals(clients.by_jid("DID_1234@ls1ok3.ecorobot.net/atom"), [bot])
+    assert_equals(clients.by_jid("did_1234@ls1ok3.ecorobot.net"), [bot])
+    assert_equals(clients.by_jid("did_1234@ls1ok3.ecorobot.net/other"), [])
+    assert_equals(clients.by_jid("fuid_1234@ecouser.net/resource_2"), [app2])
+    assert_equals(len(clients.by_jid("fuid_1234@ecouser.net")), 2)
+    assert_equals(len(clients.by_uid("fuid_1234")), 2)
+    assert_equals(clients.by_uid("did_12"), [])  # Test uids match exactly
+    assert_equals(clients.by_resource("Resource_1"), [app1])
+
+    # Test removing while iterating, and removing twice
+    for client in clients:
+        if client.uid == "fuid_1234":
+            assert_true(clients.remove(client))
+    assert_false(clients.remove(app1))
+    assert_equals(list(clients), [bot])
+    assert_false(app1 in clients)
+    assert_equals(clients.by_uid("fuid_1234"), [])
+    assert_equals(clients.by_ip("10.0.0.2"), [])
+    assert_equals(clients.by_jid("fuid_1234@ecouser.net/resource_1"), [])
+
+    clients.remove(bot)
+    assert_equals(clients.ids, {})
+    assert_equals(clients.full, {})
+    assert_true(all(index == {} for index in clients.index.values()))
+
+
+def test_stanza_set_from():
+    stanza = "<iq type=\"set\" from='spoofed@ecouser.net' id=\"1\"><query xmlns=\"com:ctl\"><ctl td=\"Clean\" from=\"keep\"/></query></iq>"
+    assert_equals(
+        bumper.xmppserver.stanza_set_from(stanza, "fuid_1234@ecouser.net/resource"),
+        '<iq from="fuid_1234@ecouser.net/resource" type="set" id="1"><query xmlns="com:ctl"><ctl td="Clean" from="keep"/></query></iq>',
+    )  # Test only the stanza's own from is replaced
+
+    assert_equals(
+        bumper.xmppserver.stanza_set_from("<iq type='result'/>", "did@ecouser.net"),
+        "<iq from=\"did@ecouser.net\" type='result'/>",
+    )
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = mock.MagicMock()
+        self.transport.get_write_buffer_size.return_value = 0
+        self.writes = []
+        self.closed = False
+        self.resumed = asyncio.Event()
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    async def drain(self):
+        await self.resumed.wait()
+
+
+def make_xmpp_client(address):
+    return bumper.xmppserver.Client(
+        uuid.uuid4(), mock.MagicMock(), FakeWriter(), (address, 5223)
+    )
+
+
+def test_client_send_buffering():
+    bumper.db_close()  # Close any open handle before removing the db
+    if os.path.exists("tests/tmp.db"):
+        os.remove("tests/tmp.db")  # Remove existing db
+    bumper.db = "tests/tmp.db"  # Set db location for testing
+    loop = asyncio.get_event_loop()
+    bumper.xmpp_send_high_water = 100
+    bumper.xmpp_send_low_water = 50
+
+    try:
+        # Test sends in one loop iteration are coalesced into one write
+        client = make_xmpp_client("10.0.0.1")
+        client.send("<iq id='1'/>")
+        client.send(b"<iq id='2'/>")
+        loop.run_until_complete(asyncio.sleep(0))
+        assert_equals(client.writer.writes, [b"<iq id='1'/><iq id='2'/>"])
+        assert_equals(client.send_stats, {"stanzas": 2, "writes": 1, "dropped": 0})
+
+        # Test drop policy discards sends above the high water mark
+        bumper.xmpp_slow_consumer = "drop"
+        client = make_xmpp_client("10.0.0.2")
+        client.send("x" * 60)
+        client.send("y" * 60)
+        loop.run_until_complete(asyncio.sleep(0))
+        assert_equals(client.writer.writes, [b"x" * 60])
+        assert_equals(client.send_stats["dropped"], 1)
+
+        # Test disconnect policy disconnects the slow consumer
+        bumper.xmpp_slow_consumer = "disconnect"
+        client = make_xmpp_client("10.0.0.3")
+        client.writer.transport.get_write_buffer_size.return_value = 200
+        client.send("x")
+        loop.run_until_complete(asyncio.sleep(0))
+        assert_equals(client.state, client.DISCONNECT)
+        assert_true(client.writer.closed)
+
+        # Test block policy makes the sender wait until the consumer drains
+        bumper.xmpp_slow_consumer = "block"
+        sender = make_xmpp_client("10.0.0.4")
+        consumer = make_xmpp_client("10.0.0.5")
+        consumer.writer.transport.get_write_buffer_size.return_value = 200
+
+        async def forward():
+            bumper.xmppserver.sending_client.set(sender)
+            consumer.send("x")
+            assert_equals(sender.congested, {consumer})
+            waiting = loop.create_task(sender._wait_for_congested())
+            await asyncio.sleep(0.05)
+            assert_false(waiting.done())  # Test sender is blocked
+            consumer.writer.resumed.set()
+            await asyncio.wait_for(waiting, 1)
+
+        loop.run_until_complete(forward())
+        assert_equals(consumer.writer.writes, [b"x"])  # Test nothing was dropped
+        assert_equals(sender.congested, set())
+
+        # Test a consumer that never drains is disconnected after the timeout
+        bumper.xmpp_block_timeout = 0.05
+        consumer = make_xmpp_client("10.0.0.6")
+        consumer.writer.transport.get_write_buffer_size.return_value = 200
+
+        async def forward_stalled():
+            bumper.xmppserver.sending_client.set(sender)
+            consumer.send("x")
+            await sender._wait_for_congested()
+
+        loop.run_until_complete(forward_stalled())
+        assert_equals(consumer.state, consumer.DISCONNECT)
+
+    finally:
+        bumper.xmpp_send_high_water = 256 * 1024
+        bumper.xmpp_send_low_water = 64 * 1024
+        bumper.xmpp_slow_consumer = "disconnect"
+        bumper.xmpp_block_timeout = 10